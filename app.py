@@ -1,23 +1,32 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import face_recognition
 import numpy as np
 import cv2
 import os
-import time
-import hashlib
-import uuid
-import requests
 import json
+import secrets
 from urllib.parse import urlencode
-import pymongo
 from bson.binary import Binary
 import pickle
 
 from cbir_functions import (
-    glcm, haralik_feat, simple_bit, concat, 
+    glcm, haralik_feat, bit_feat, concat, 
     manhattan_distance, euclidean_distance, chebyshev_distance, canberra_distance,
     recherche_images, extraction_signatures, save_uploaded_image, cbir_page
 )
+from auth_functions import (
+    GOOGLE_CLIENT_ID, FACEBOOK_APP_ID, REDIRECT_URI, FACE_MATCH_THRESHOLD, MAX_FACE_ENCODINGS,
+    get_user_by_username, insert_user, update_user, add_face_encoding,
+    get_user_face_encodings, identify_face, verify_face, hash_password,
+    OAuthError, fetch_google_user_info, fetch_facebook_user_info, find_or_create_oauth_user
+)
+from metrics import chronometre
+from services import demarrer_services
+from session_store import (
+    SESSION_TTL, OAUTH_STATE_TTL, get_session_store, create_session, load_session, delete_session,
+    create_oauth_state, consume_oauth_state
+)
 # Configuration de la page
 st.set_page_config(page_title="Authentification avec Reconnaissance Faciale", layout="wide")
 
@@ -25,21 +34,10 @@ st.set_page_config(page_title="Authentification avec Reconnaissance Faciale", la
 DATASET_PATH = "./animalsCbir/"
 SIGNATURES_PATH = "./signatures/"
 
-# Configuration OAuth
-GOOGLE_CLIENT_ID = ""
-GOOGLE_CLIENT_SECRET = ""
-FACEBOOK_APP_ID = ""
-FACEBOOK_APP_SECRET = ""
-REDIRECT_URI = ""
-
-# Configuration MongoDB
-MONGODB_URI = ""
-
-# Connexion à MongoDB
-@st.cache_resource
-def get_database():
-    client = pymongo.MongoClient(MONGODB_URI)
-    return client["cbir-auth-app"]
+# Cookie portant le jeton de session (jamais placé dans l'URL)
+SESSION_COOKIE = "cbir_session"
+# Cookie liant un état OAuth au navigateur qui a lancé la connexion
+OAUTH_NONCE_COOKIE = "cbir_oauth_nonce"
 
 # Initialisation des variables de session
 if 'authenticated' not in st.session_state:
@@ -48,53 +46,94 @@ if 'current_user' not in st.session_state:
     st.session_state.current_user = None
 if 'auth_method' not in st.session_state:
     st.session_state.auth_method = None
-if 'oauth_state' not in st.session_state:
-    st.session_state.oauth_state = str(uuid.uuid4())
-if 'oauth_provider' not in st.session_state:
-    st.session_state.oauth_provider = None
 if 'redirect_page' not in st.session_state:
     st.session_state.redirect_page = None
 if 'uploaded_image' not in st.session_state:
     st.session_state.uploaded_image = None
 if 'search_results' not in st.session_state:
     st.session_state.search_results = None
+if 'session_token' not in st.session_state:
+    st.session_state.session_token = None
+if 'pending_cookies' not in st.session_state:
+    st.session_state.pending_cookies = {}
 
-# Fonctions utilitaires pour MongoDB
-def get_user_collection():
-    db = get_database()
-    return db["users"]
-
-def get_user_by_username(username):
-    users = get_user_collection()
-    return users.find_one({"username": username})
-
-def get_user_by_google_id(google_id):
-    users = get_user_collection()
-    return users.find_one({"auth_methods.google_id": google_id})
+def write_cookies():
+    """Déposer ou effacer dans le navigateur les cookies demandés depuis la dernière écriture"""
+    if not st.session_state.pending_cookies:
+        return
+    # Les valeurs ne contiennent que des caractères URL-safe et des points
+    script = "".join(
+        f"window.parent.document.cookie = '{name}={value}; Max-Age={max_age}; Path=/; SameSite=Lax' + secure;"
+        for name, (value, max_age) in st.session_state.pending_cookies.items()
+    )
+    st.session_state.pending_cookies = {}
+    components.html(
+        f"<script>const secure = window.parent.location.protocol === 'https:' ? '; Secure' : ''; {script}</script>",
+        height=0
+    )
 
-def get_user_by_facebook_id(facebook_id):
-    users = get_user_collection()
-    return users.find_one({"auth_methods.facebook_id": facebook_id})
+def start_oauth_flow(provider, redirect_page):
+    """Émettre un état OAuth lié à ce navigateur par un cookie (protection contre le login CSRF)"""
+    nonce = secrets.token_urlsafe(24)
+    state = create_oauth_state(get_session_store(), provider, redirect_page, nonce)
+    # Écrit immédiatement : l'utilisateur quitte la page par le lien, sans nouvelle exécution
+    st.session_state.pending_cookies[OAUTH_NONCE_COOKIE] = (nonce, OAUTH_STATE_TTL)
+    write_cookies()
+    return state
 
-def get_user_by_email(email):
-    users = get_user_collection()
-    return users.find_one({"email": email})
+def login_user(username, auth_method):
+    """Authentifier l'utilisateur et ouvrir une session valable sur toutes les répliques"""
+    st.session_state.authenticated = True
+    st.session_state.current_user = username
+    st.session_state.auth_method = auth_method
+    # Le jeton signé est un identifiant porteur : il voyage dans un cookie, pas dans l'URL
+    token = create_session(get_session_store(), username, auth_method)
+    st.session_state.session_token = token
+    st.session_state.pending_cookies[SESSION_COOKIE] = (token, SESSION_TTL)
 
-def insert_user(user_data):
-    users = get_user_collection()
-    return users.insert_one(user_data)
-
-def update_user(username, update_data):
-    users = get_user_collection()
-    return users.update_one({"username": username}, {"$set": update_data})
-
-def get_all_users_with_face():
-    users = get_user_collection()
-    return list(users.find({"has_face_encoding": True}))
+def logout_user():
+    """Fermer la session de l'utilisateur"""
+    token = st.session_state.session_token or st.context.cookies.get(SESSION_COOKIE)
+    if token:
+        delete_session(get_session_store(), token)
+        st.session_state.pending_cookies[SESSION_COOKIE] = ("", 0)
+    st.session_state.session_token = None
+    st.session_state.authenticated = False
+    st.session_state.current_user = None
+    st.session_state.auth_method = None
 
-def hash_password(password):
-    """Hacher un mot de passe"""
-    return hashlib.sha256(password.encode()).hexdigest()
+def restore_session():
+    """Synchroniser l'authentification avec la session côté serveur à chaque exécution"""
+    # Anciens liens portant le jeton dans l'URL : le retirer de la barre d'adresse
+    if "session" in st.query_params:
+        del st.query_params["session"]
+    
+    # Session ouverte : elle a pu expirer ou être fermée depuis un autre onglet ou une autre réplique
+    if st.session_state.authenticated:
+        token = st.session_state.session_token
+        if token is None or load_session(get_session_store(), token) is None:
+            logout_user()
+        return
+    
+    # Les cookies sont ceux de l'ouverture de la connexion : une seule lecture par session Streamlit
+    if st.session_state.get('session_restored'):
+        return
+    st.session_state.session_restored = True
+    
+    token = st.context.cookies.get(SESSION_COOKIE)
+    if not token:
+        return
+    
+    session = load_session(get_session_store(), token)
+    if session is None:
+        # Jeton expiré, révoqué ou falsifié
+        logout_user()
+        return
+    
+    st.session_state.authenticated = True
+    st.session_state.current_user = session['username']
+    st.session_state.auth_method = session['auth_method']
+    st.session_state.session_token = token
 
 def capture_face():
     """Capturer une image depuis la webcam et extraire l'encodage facial"""
@@ -107,7 +146,8 @@ def capture_face():
         img = cv2.imdecode(np.frombuffer(bytes_data, np.uint8), cv2.IMREAD_COLOR)
         rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         
-        face_locations = face_recognition.face_locations(rgb_img)
+        with chronometre("detection_visage"):
+            face_locations = face_recognition.face_locations(rgb_img)
         
         if len(face_locations) == 0:
             st.error("Aucun visage détecté! Veuillez réessayer.")
@@ -116,7 +156,8 @@ def capture_face():
             st.error("Plusieurs visages détectés! Un seul visage est nécessaire.")
             return None
         
-        face_encodings = face_recognition.face_encodings(rgb_img, face_locations)
+        with chronometre("encodage_visage"):
+            face_encodings = face_recognition.face_encodings(rgb_img, face_locations)
         
         if face_encodings:
             # Dessiner un rectangle autour du visage
@@ -130,25 +171,25 @@ def capture_face():
     
     return None
 
-def get_google_auth_url():
+def get_google_auth_url(state):
     """Générer l'URL d'authentification Google"""
     params = {
         'client_id': GOOGLE_CLIENT_ID,
         'redirect_uri': REDIRECT_URI,
         'response_type': 'code',
         'scope': 'openid email profile',
-        'state': st.session_state.oauth_state,
+        'state': state,
         'access_type': 'offline',
         'prompt': 'consent'
     }
     return f"https://accounts.google.com/o/oauth2/auth?{urlencode(params)}"
 
-def get_facebook_auth_url():
+def get_facebook_auth_url(state):
     """Générer l'URL d'authentification Facebook"""
     params = {
         'client_id': FACEBOOK_APP_ID,
         'redirect_uri': REDIRECT_URI,
-        'state': st.session_state.oauth_state,
+        'state': state,
         'scope': 'email,public_profile'
     }
     return f"https://www.facebook.com/v13.0/dialog/oauth?{urlencode(params)}"
@@ -161,8 +202,10 @@ def process_oauth_callback():
         code = query_params['code']
         state = query_params['state']
         
-        # Vérifier que l'état correspond pour éviter les attaques CSRF
-        if state != st.session_state.oauth_state:
+        # Vérifier que l'état a été émis par l'application pour ce navigateur (attaques CSRF)
+        oauth_context = consume_oauth_state(get_session_store(), state, st.context.cookies.get(OAUTH_NONCE_COOKIE))
+        st.session_state.pending_cookies[OAUTH_NONCE_COOKIE] = ("", 0)
+        if oauth_context is None:
             st.error("État OAuth invalide. Tentative d'attaque potentielle.")
             return False, None
         
@@ -172,7 +215,8 @@ def process_oauth_callback():
             return False, None
         
         # Obtenir un token en fonction du code
-        provider = st.session_state.oauth_provider
+        provider = oauth_context['provider']
+        st.session_state.redirect_page = oauth_context['redirect_page']
         
         if provider == 'google':
             return exchange_google_code(code)
@@ -184,68 +228,17 @@ def process_oauth_callback():
 def exchange_google_code(code):
     """Échanger le code d'autorisation Google contre un token d'accès"""
     try:
-        token_url = 'https://oauth2.googleapis.com/token'
-        data = {
-            'code': code,
-            'client_id': GOOGLE_CLIENT_ID,
-            'client_secret': GOOGLE_CLIENT_SECRET,
-            'redirect_uri': REDIRECT_URI,
-            'grant_type': 'authorization_code'
-        }
-        
-        response = requests.post(token_url, data=data)
-        token_data = response.json()
-        
-        if 'access_token' not in token_data:
-            st.error(f"Erreur lors de l'échange du code: {token_data.get('error_description', 'Inconnu')}")
-            return False, None
-        
-        # Obtenir les informations de l'utilisateur
-        user_info_url = 'https://www.googleapis.com/oauth2/v1/userinfo'
-        headers = {'Authorization': f"Bearer {token_data['access_token']}"}
-        user_response = requests.get(user_info_url, headers=headers)
-        user_info = user_response.json()
-        
-        if 'id' not in user_info:
-            st.error("Impossible d'obtenir les informations de l'utilisateur")
-            return False, None
-        
-        # Chercher l'utilisateur par Google ID
-        existing_user = get_user_by_google_id(user_info['id'])
-        
-        # Si non trouvé, chercher par email
-        if not existing_user and 'email' in user_info:
-            existing_user = get_user_by_email(user_info['email'])
-            
-            if existing_user:
-                # Ajouter l'authentification Google
-                update_user(existing_user['username'], {
-                    "auth_methods.google": True,
-                    "auth_methods.google_id": user_info['id']
-                })
-        
-        # Si toujours pas trouvé, créer un nouvel utilisateur
-        if not existing_user:
-            username = f"google_{user_info.get('name', '').replace(' ', '_').lower()}_{uuid.uuid4().hex[:6]}"
-            new_user = {
-                'username': username,
-                'email': user_info.get('email', ''),
-                'auth_methods': {
-                    'google': True,
-                    'google_id': user_info['id']
-                },
-                'has_face_encoding': False
-            }
-            insert_user(new_user)
-            existing_user = get_user_by_username(username)
+        user_info = fetch_google_user_info(code)
+        username = find_or_create_oauth_user('google', user_info)
         
         # Authentifier l'utilisateur
-        st.session_state.authenticated = True
-        st.session_state.current_user = existing_user['username']
-        st.session_state.auth_method = 'google'
+        login_user(username, 'google')
         
-        return True, existing_user['username']
+        return True, username
         
+    except OAuthError as e:
+        st.error(str(e))
+        return False, None
     except Exception as e:
         st.error(f"Erreur lors de l'authentification Google: {str(e)}")
         return False, None
@@ -253,70 +246,17 @@ def exchange_google_code(code):
 def exchange_facebook_code(code):
     """Échanger le code d'autorisation Facebook contre un token d'accès"""
     try:
-        token_url = 'https://graph.facebook.com/v13.0/oauth/access_token'
-        params = {
-            'client_id': FACEBOOK_APP_ID,
-            'client_secret': FACEBOOK_APP_SECRET,
-            'redirect_uri': REDIRECT_URI,
-            'code': code
-        }
-        
-        response = requests.get(token_url, params=params)
-        token_data = response.json()
-        
-        if 'access_token' not in token_data:
-            st.error(f"Erreur lors de l'échange du code: {token_data.get('error', {}).get('message', 'Inconnu')}")
-            return False, None
-        
-        # Obtenir les informations de l'utilisateur
-        user_info_url = 'https://graph.facebook.com/me'
-        params = {
-            'fields': 'id,name,email',
-            'access_token': token_data['access_token']
-        }
-        user_response = requests.get(user_info_url, params=params)
-        user_info = user_response.json()
-        
-        if 'id' not in user_info:
-            st.error("Impossible d'obtenir les informations de l'utilisateur")
-            return False, None
-        
-        # Chercher l'utilisateur par Facebook ID
-        existing_user = get_user_by_facebook_id(user_info['id'])
-        
-        # Si non trouvé, chercher par email
-        if not existing_user and 'email' in user_info:
-            existing_user = get_user_by_email(user_info['email'])
-            
-            if existing_user:
-                # Ajouter l'authentification Facebook
-                update_user(existing_user['username'], {
-                    "auth_methods.facebook": True,
-                    "auth_methods.facebook_id": user_info['id']
-                })
-        
-        # Si toujours pas trouvé, créer un nouvel utilisateur
-        if not existing_user:
-            username = f"fb_{user_info.get('name', '').replace(' ', '_').lower()}_{uuid.uuid4().hex[:6]}"
-            new_user = {
-                'username': username,
-                'email': user_info.get('email', ''),
-                'auth_methods': {
-                    'facebook': True,
-                    'facebook_id': user_info['id']
-                },
-                'has_face_encoding': False
-            }
-            insert_user(new_user)
-            existing_user = get_user_by_username(username)
+        user_info = fetch_facebook_user_info(code)
+        username = find_or_create_oauth_user('facebook', user_info)
         
         # Authentifier l'utilisateur
-        st.session_state.authenticated = True
-        st.session_state.current_user = existing_user['username']
-        st.session_state.auth_method = 'facebook'
+        login_user(username, 'facebook')
         
-        return True, existing_user['username']
+        return True, username
         
+    except OAuthError as e:
+        st.error(str(e))
+        return False, None
     except Exception as e:
         st.error(f"Erreur lors de l'authentification Facebook: {str(e)}")
         return False, None
@@ -380,7 +320,7 @@ def signup_page():
                             'username': username,
                             'email': email,
                             'auth_methods': {'face': True},
-                            'face_encoding': face_encoding_binary,
+                            'face_encodings': [face_encoding_binary],
                             'has_face_encoding': True
                         }
                         insert_user(new_user)
@@ -391,9 +331,8 @@ def signup_page():
         st.write("Inscription avec Google")
         
         if st.button("S'inscrire avec Google"):
-            st.session_state.oauth_provider = 'google'
-            st.session_state.redirect_page = 'signup'
-            auth_url = get_google_auth_url()
+            state = start_oauth_flow('google', 'signup')
+            auth_url = get_google_auth_url(state)
             st.markdown(f'<a href="{auth_url}" target="_self">Cliquez ici pour vous connecter avec Google</a>', unsafe_allow_html=True)
     
     # Onglet Facebook
@@ -401,9 +340,8 @@ def signup_page():
         st.write("Inscription avec Facebook")
         
         if st.button("S'inscrire avec Facebook"):
-            st.session_state.oauth_provider = 'facebook'
-            st.session_state.redirect_page = 'signup'
-            auth_url = get_facebook_auth_url()
+            state = start_oauth_flow('facebook', 'signup')
+            auth_url = get_facebook_auth_url(state)
             st.markdown(f'<a href="{auth_url}" target="_self">Cliquez ici pour vous connecter avec Facebook</a>', unsafe_allow_html=True)
 
 def login_page():
@@ -431,9 +369,7 @@ def login_page():
                     elif user['password_hash'] != hash_password(password):
                         st.error("Mot de passe incorrect")
                     else:
-                        st.session_state.authenticated = True
-                        st.session_state.current_user = username
-                        st.session_state.auth_method = 'local'
+                        login_user(username, 'local')
                         st.success(f"Bienvenue, {username}!")
                         st.rerun()
     
@@ -441,29 +377,19 @@ def login_page():
     with login_tabs[1]:
         st.write("Connectez-vous avec votre visage")
         
+        # Avec un nom d'utilisateur, seul ce compte est comparé (vérification 1:1)
+        face_username = st.text_input("Nom d'utilisateur (facultatif)", key="face_login_username")
+        
         face_encoding = capture_face()
         
         if face_encoding is not None:
-            users_with_face = get_all_users_with_face()
-            best_match = None
-            lowest_distance = float('inf')
-            threshold = 0.6  # Seuil de similarité
-            
-            for user in users_with_face:
-                if user.get('face_encoding') is not None:
-                    # Convertir le binaire en tableau numpy
-                    stored_encoding = pickle.loads(user['face_encoding'])
-                    distances = face_recognition.face_distance([stored_encoding], face_encoding)
-                    distance = distances[0]
-                    
-                    if distance < lowest_distance:
-                        lowest_distance = distance
-                        best_match = user
+            if face_username:
+                best_match, lowest_distance = verify_face(face_username, face_encoding)
+            else:
+                best_match, lowest_distance = identify_face(face_encoding)
             
-            if best_match and lowest_distance < threshold:
-                st.session_state.authenticated = True
-                st.session_state.current_user = best_match['username']
-                st.session_state.auth_method = 'face'
+            if best_match and lowest_distance < FACE_MATCH_THRESHOLD:
+                login_user(best_match['username'], 'face')
                 st.success(f"Visage reconnu! Bienvenue, {best_match['username']}!")
                 st.rerun()
             else:
@@ -474,9 +400,8 @@ def login_page():
         st.write("Connexion avec Google")
         
         if st.button("Se connecter avec Google"):
-            st.session_state.oauth_provider = 'google'
-            st.session_state.redirect_page = 'login'
-            auth_url = get_google_auth_url()
+            state = start_oauth_flow('google', 'login')
+            auth_url = get_google_auth_url(state)
             st.markdown(f'<a href="{auth_url}" target="_self">Cliquez ici pour vous connecter avec Google</a>', unsafe_allow_html=True)
     
     # Onglet Facebook
@@ -484,9 +409,8 @@ def login_page():
         st.write("Connexion avec Facebook")
         
         if st.button("Se connecter avec Facebook"):
-            st.session_state.oauth_provider = 'facebook'
-            st.session_state.redirect_page = 'login'
-            auth_url = get_facebook_auth_url()
+            state = start_oauth_flow('facebook', 'login')
+            auth_url = get_facebook_auth_url(state)
             st.markdown(f'<a href="{auth_url}" target="_self">Cliquez ici pour vous connecter avec Facebook</a>', unsafe_allow_html=True)
 
 def profile_page():
@@ -543,19 +467,14 @@ def profile_page():
         
         # Ajouter/mettre à jour la reconnaissance faciale
         with st.expander("Reconnaissance faciale"):
-            st.write("Mettre à jour votre visage pour l'authentification")
+            st.write("Ajouter un visage pour l'authentification")
+            st.caption(f"{len(get_user_face_encodings(user))} visage(s) enregistré(s), "
+                       f"{MAX_FACE_ENCODINGS} au maximum : les plus anciens sont remplacés.")
             
             face_encoding = capture_face()
             
             if face_encoding is not None and st.button("Enregistrer ce visage"):
-                # Convertir le tableau numpy en binaire pour MongoDB
-                face_encoding_binary = Binary(pickle.dumps(face_encoding, protocol=2))
-                
-                update_user(st.session_state.current_user, {
-                    "face_encoding": face_encoding_binary,
-                    "has_face_encoding": True,
-                    "auth_methods.face": True
-                })
+                add_face_encoding(st.session_state.current_user, face_encoding)
                 st.success("Visage enregistré!")
                 st.rerun()
         
@@ -563,35 +482,38 @@ def profile_page():
         if not auth_methods.get('google', False):
             with st.expander("Connecter Google"):
                 if st.button("Lier un compte Google"):
-                    st.session_state.oauth_provider = 'google'
-                    st.session_state.redirect_page = 'profile'
-                    auth_url = get_google_auth_url()
+                    state = start_oauth_flow('google', 'profile')
+                    auth_url = get_google_auth_url(state)
                     st.markdown(f'<a href="{auth_url}" target="_self">Cliquez ici pour lier votre compte Google</a>', unsafe_allow_html=True)
         
         # Ajouter Facebook si non existant
         if not auth_methods.get('facebook', False):
             with st.expander("Connecter Facebook"):
                 if st.button("Lier un compte Facebook"):
-                    st.session_state.oauth_provider = 'facebook'
-                    st.session_state.redirect_page = 'profile'
-                    auth_url = get_facebook_auth_url()
+                    state = start_oauth_flow('facebook', 'profile')
+                    auth_url = get_facebook_auth_url(state)
                     st.markdown(f'<a href="{auth_url}" target="_self">Cliquez ici pour lier votre compte Facebook</a>', unsafe_allow_html=True)
     
     # Déconnexion
     if st.button("Se déconnecter", type="primary"):
-        st.session_state.authenticated = False
-        st.session_state.current_user = None
-        st.session_state.auth_method = None
+        logout_user()
         st.success("Vous êtes déconnecté")
         st.rerun()
 
 def main():
     """Fonction principale de l'application"""
     st.title("Application CBIR avec Authentification Multiple")
+    # Déjà démarrés par serve.py ; sinon (streamlit run app.py) au premier passage
+    demarrer_services()
+    restore_session()
+    write_cookies()
     
     # Vérifier s'il y a un callback OAuth
     if 'code' in st.query_params and 'state' in st.query_params:
         is_authenticated, username = process_oauth_callback()
+        # L'état OAuth est à usage unique : ne pas retraiter le callback à la prochaine exécution
+        del st.query_params['code']
+        del st.query_params['state']
         if is_authenticated:
             st.success(f"Authentification réussie! Bienvenue, {username}!")
             # Rediriger vers la page principale après une connexion réussie
@@ -609,8 +531,7 @@ def main():
             
             # Bouton de déconnexion rapide
             if st.button("Déconnexion"):
-                st.session_state.authenticated = False
-                st.session_state.current_user = None
+                logout_user()
                 st.rerun()
         else:
             st.warning("Non connecté")
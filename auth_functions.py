@@ -0,0 +1,266 @@
+import streamlit as st
+import face_recognition
+import numpy as np
+import hashlib
+import uuid
+import requests
+import pymongo
+from bson.binary import Binary
+import pickle
+
+from metrics import chronometre, chronometre_fonction
+
+# Configuration OAuth
+GOOGLE_CLIENT_ID = ""
+GOOGLE_CLIENT_SECRET = ""
+FACEBOOK_APP_ID = ""
+FACEBOOK_APP_SECRET = ""
+REDIRECT_URI = ""
+
+GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v1/userinfo"
+FACEBOOK_TOKEN_URL = "https://graph.facebook.com/v13.0/oauth/access_token"
+FACEBOOK_USERINFO_URL = "https://graph.facebook.com/me"
+
+# Configuration MongoDB
+MONGODB_URI = ""
+
+# Reconnaissance faciale
+FACE_MATCH_THRESHOLD = 0.6  # Seuil de similarité
+MAX_FACE_ENCODINGS = 5  # Nombre d'encodages conservés par compte
+
+# Base de données de remplacement (tests de charge), prioritaire sur MongoDB
+_database_override = None
+
+# Connexion à MongoDB
+@st.cache_resource
+def get_database():
+    client = pymongo.MongoClient(MONGODB_URI)
+    db = client["cbir-auth-app"]
+    # Index utilisé par la connexion et la vérification faciale 1:1
+    db["users"].create_index("username")
+    return db
+
+def warm_database():
+    """Ouvrir le pool de connexions MongoDB"""
+    db = get_database()
+    db.client.admin.command("ping")
+
+def set_database(db):
+    """Remplacer la base MongoDB (None pour revenir à la connexion configurée)"""
+    global _database_override
+    _database_override = db
+
+# Fonctions utilitaires pour MongoDB
+def get_user_collection():
+    db = _database_override if _database_override is not None else get_database()
+    return db["users"]
+
+@chronometre_fonction("mongo_find_one")
+def get_user_by_username(username):
+    users = get_user_collection()
+    return users.find_one({"username": username})
+
+@chronometre_fonction("mongo_find_one")
+def get_user_by_google_id(google_id):
+    users = get_user_collection()
+    return users.find_one({"auth_methods.google_id": google_id})
+
+@chronometre_fonction("mongo_find_one")
+def get_user_by_facebook_id(facebook_id):
+    users = get_user_collection()
+    return users.find_one({"auth_methods.facebook_id": facebook_id})
+
+@chronometre_fonction("mongo_find_one")
+def get_user_by_email(email):
+    users = get_user_collection()
+    return users.find_one({"email": email})
+
+@chronometre_fonction("mongo_insert_one")
+def insert_user(user_data):
+    users = get_user_collection()
+    return users.insert_one(user_data)
+
+@chronometre_fonction("mongo_update_one")
+def update_user(username, update_data):
+    users = get_user_collection()
+    return users.update_one({"username": username}, {"$set": update_data})
+
+@chronometre_fonction("mongo_find")
+def get_all_users_with_face():
+    users = get_user_collection()
+    return list(users.find({"has_face_encoding": True}))
+
+@chronometre_fonction("mongo_find_one")
+def get_face_user_by_username(username):
+    users = get_user_collection()
+    return users.find_one(
+        {"username": username, "has_face_encoding": True},
+        {"username": 1, "face_encoding": 1, "face_encodings": 1}
+    )
+
+def _migrate_legacy_face_encoding(users, username):
+    """Déplace l'ancien champ unique `face_encoding` en tête de `face_encodings`"""
+    user = users.find_one({"username": username}, {"face_encoding": 1})
+    if user is None or user.get("face_encoding") is None:
+        return
+    
+    # Filtre sur la valeur lue : une seule migration concurrente aboutit
+    users.update_one({"username": username, "face_encoding": user["face_encoding"]}, {
+        "$push": {"face_encodings": {"$each": [user["face_encoding"]], "$position": 0}},
+        "$unset": {"face_encoding": ""}
+    })
+
+@chronometre_fonction("mongo_update_one")
+def add_face_encoding(username, face_encoding):
+    """Ajouter un encodage facial au compte (les plus anciens au-delà de MAX_FACE_ENCODINGS sont retirés)"""
+    users = get_user_collection()
+    # L'ancien encodage doit être compté et remplacé comme les autres
+    _migrate_legacy_face_encoding(users, username)
+    face_encoding_binary = Binary(pickle.dumps(face_encoding, protocol=2))
+    return users.update_one({"username": username}, {
+        "$push": {"face_encodings": {"$each": [face_encoding_binary], "$slice": -MAX_FACE_ENCODINGS}},
+        "$set": {"has_face_encoding": True, "auth_methods.face": True}
+    })
+
+def get_user_face_encodings(user):
+    """Encodages faciaux d'un utilisateur (liste et ancien champ unique, pas encore migré)"""
+    encodings = [pickle.loads(binary) for binary in user.get('face_encodings', [])]
+    if user.get('face_encoding') is not None:
+        encodings.append(pickle.loads(user['face_encoding']))
+    return encodings
+
+def warm_face_models():
+    """Charger les modèles dlib de détection et d'encodage facial"""
+    img = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_locations(img)
+    face_recognition.face_encodings(img, known_face_locations=[(0, 64, 64, 0)])
+
+def face_distance_to_user(user, face_encoding):
+    """Distance minimale entre un visage et les encodages enregistrés d'un utilisateur"""
+    encodings = get_user_face_encodings(user)
+    if not encodings:
+        return float('inf')
+    return float(np.min(face_recognition.face_distance(encodings, face_encoding)))
+
+def identify_face(face_encoding):
+    """Identification 1:N : utilisateur le plus proche parmi tous les comptes avec visage"""
+    users_with_face = get_all_users_with_face()
+    best_match = None
+    lowest_distance = float('inf')
+    
+    with chronometre("correspondance_visage"):
+        for user in users_with_face:
+            distance = face_distance_to_user(user, face_encoding)
+            if distance < lowest_distance:
+                lowest_distance = distance
+                best_match = user
+    
+    return best_match, lowest_distance
+
+def verify_face(username, face_encoding):
+    """Vérification 1:1 : compare le visage aux seuls encodages du compte indiqué"""
+    user = get_face_user_by_username(username)
+    if user is None:
+        return None, float('inf')
+    
+    with chronometre("correspondance_visage"):
+        distance = face_distance_to_user(user, face_encoding)
+    return user, distance
+
+def hash_password(password):
+    """Hacher un mot de passe"""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+class OAuthError(Exception):
+    """Échec de l'échange OAuth, avec un message affichable"""
+
+def fetch_google_user_info(code):
+    """Échanger le code d'autorisation Google et obtenir le profil de l'utilisateur"""
+    data = {
+        'code': code,
+        'client_id': GOOGLE_CLIENT_ID,
+        'client_secret': GOOGLE_CLIENT_SECRET,
+        'redirect_uri': REDIRECT_URI,
+        'grant_type': 'authorization_code'
+    }
+    
+    response = requests.post(GOOGLE_TOKEN_URL, data=data)
+    token_data = response.json()
+    
+    if 'access_token' not in token_data:
+        raise OAuthError(f"Erreur lors de l'échange du code: {token_data.get('error_description', 'Inconnu')}")
+    
+    # Obtenir les informations de l'utilisateur
+    headers = {'Authorization': f"Bearer {token_data['access_token']}"}
+    user_response = requests.get(GOOGLE_USERINFO_URL, headers=headers)
+    user_info = user_response.json()
+    
+    if 'id' not in user_info:
+        raise OAuthError("Impossible d'obtenir les informations de l'utilisateur")
+    return user_info
+
+def fetch_facebook_user_info(code):
+    """Échanger le code d'autorisation Facebook et obtenir le profil de l'utilisateur"""
+    params = {
+        'client_id': FACEBOOK_APP_ID,
+        'client_secret': FACEBOOK_APP_SECRET,
+        'redirect_uri': REDIRECT_URI,
+        'code': code
+    }
+    
+    response = requests.get(FACEBOOK_TOKEN_URL, params=params)
+    token_data = response.json()
+    
+    if 'access_token' not in token_data:
+        raise OAuthError(f"Erreur lors de l'échange du code: {token_data.get('error', {}).get('message', 'Inconnu')}")
+    
+    # Obtenir les informations de l'utilisateur
+    params = {
+        'fields': 'id,name,email',
+        'access_token': token_data['access_token']
+    }
+    user_response = requests.get(FACEBOOK_USERINFO_URL, params=params)
+    user_info = user_response.json()
+    
+    if 'id' not in user_info:
+        raise OAuthError("Impossible d'obtenir les informations de l'utilisateur")
+    return user_info
+
+def find_or_create_oauth_user(provider, user_info):
+    """Retrouver (par identifiant OAuth puis par email) ou créer le compte lié au profil"""
+    if provider == 'google':
+        existing_user = get_user_by_google_id(user_info['id'])
+        prefix = 'google'
+    else:
+        existing_user = get_user_by_facebook_id(user_info['id'])
+        prefix = 'fb'
+    
+    # Si non trouvé, chercher par email
+    if not existing_user and 'email' in user_info:
+        existing_user = get_user_by_email(user_info['email'])
+        
+        if existing_user:
+            # Ajouter la méthode d'authentification au compte existant
+            update_user(existing_user['username'], {
+                f"auth_methods.{provider}": True,
+                f"auth_methods.{provider}_id": user_info['id']
+            })
+    
+    # Si toujours pas trouvé, créer un nouvel utilisateur
+    if not existing_user:
+        username = f"{prefix}_{user_info.get('name', '').replace(' ', '_').lower()}_{uuid.uuid4().hex[:6]}"
+        new_user = {
+            'username': username,
+            'email': user_info.get('email', ''),
+            'auth_methods': {
+                provider: True,
+                f"{provider}_id": user_info['id']
+            },
+            'has_face_encoding': False
+        }
+        insert_user(new_user)
+        existing_user = get_user_by_username(username)
+    
+    return existing_user['username']
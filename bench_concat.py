@@ -0,0 +1,71 @@
+"""Latence d'extraction d'une image requête : `concat` séquentiel contre `concat_parallele`
+
+Avec `--clients`, plusieurs threads extraient en même temps, comme des sessions concurrentes
+partageant le pool de descripteurs.
+
+    python bench_concat.py --tailles 256 512 1024 --repetitions 30
+    python bench_concat.py --images requete1.jpg requete2.jpg
+    python bench_concat.py --clients 1 4 16
+"""
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from cbir_functions import NB_WORKERS_DESCRIPTEURS, concat, concat_parallele, lire_image_gris
+
+
+def mesurer(fonction, image, repetitions):
+    """Durées (ms) de `repetitions` appels, après un appel de chauffe"""
+    fonction(image)
+    durees = []
+    for _ in range(repetitions):
+        debut = time.perf_counter()
+        fonction(image)
+        durees.append(1000 * (time.perf_counter() - debut))
+    return np.array(durees)
+
+
+def mesurer_concurrents(fonction, image, repetitions, clients):
+    """Durées (ms) des appels de `clients` threads effectuant chacun `repetitions` appels"""
+    if clients == 1:
+        return mesurer(fonction, image, repetitions)
+    with ThreadPoolExecutor(max_workers=clients) as executeur:
+        return np.concatenate(list(executeur.map(lambda _: mesurer(fonction, image, repetitions), range(clients))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare l'extraction séquentielle et parallèle de Concat")
+    parser.add_argument("--tailles", nargs="*", type=int, default=[256, 512, 1024],
+                        help="Côtés des images synthétiques")
+    parser.add_argument("--images", nargs="*", help="Images réelles (décodées à la taille canonique)")
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--clients", nargs="*", type=int, default=[1], help="Nombre d'extractions simultanées")
+    args = parser.parse_args(argv)
+
+    if args.images:
+        images = [(chemin, lire_image_gris(chemin)) for chemin in args.images]
+    else:
+        rng = np.random.default_rng(0)
+        images = [
+            (f"{t}x{t}", cv2.GaussianBlur(rng.integers(0, 256, (t, t), dtype=np.uint8), (0, 0), 2.0))
+            for t in args.tailles
+        ]
+
+    print(f"Pool de descripteurs: {NB_WORKERS_DESCRIPTEURS} thread(s)")
+    print(f"{'Image':<24} {'Clients':>7} {'Séq. p50':>9} {'Par. p50':>9} {'Séq. p95':>9} {'Par. p95':>9} {'Gain':>6}")
+    for nom, image in images:
+        for clients in args.clients:
+            sequentiel = mesurer_concurrents(concat, image, args.repetitions, clients)
+            parallele = mesurer_concurrents(concat_parallele, image, args.repetitions, clients)
+            print(f"{nom:<24} {clients:>7} {np.median(sequentiel):>9.1f} {np.median(parallele):>9.1f} "
+                  f"{np.percentile(sequentiel, 95):>9.1f} {np.percentile(parallele, 95):>9.1f} "
+                  f"{np.median(sequentiel) / np.median(parallele):>5.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,21 +2,130 @@ import streamlit as st
 import numpy as np
 import cv2
 import os
-import time
+import json
+import hashlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from skimage.feature import graycomatrix, graycoprops
 from mahotas.features import haralick
 from scipy.spatial import distance
+from scipy.special import gammaln
+
+from jobs import etat_travaux, soumettre_travail
+from metrics import chronometre, chronometre_fonction
+from thumbnails import construire_miniatures, obtenir_miniature
+
+logger = logging.getLogger("cbir.recherche")
 
 DATASET_PATH = "./animalsCbir/"
 SIGNATURES_PATH = "./signatures/"
 
+# Noms des descripteurs dans l'interface et suffixes des fichiers de signatures
+DESCRIPTEURS = {
+    "GLCM": "Glcm",
+    "Haralick": "Haralick",
+    "BiT": "Bit",
+    "Concaténation": "Concat"
+}
+
+# Nombre de caractéristiques attendu dans chaque fichier de signatures
+DIMENSIONS = {
+    "Glcm": 6,
+    "Haralick": 13,
+    "Bit": 16,
+    "Concat": 35
+}
+
+# Version de chaque descripteur, à incrémenter quand son calcul change (signatures à réextraire)
+VERSIONS_DESCRIPTEURS = {
+    "Glcm": 1,
+    "Haralick": 1,
+    "Bit": 2,
+    "Concat": 2
+}
+
+
+# Plus grand côté (pixels) des images passées aux descripteurs, identique à l'indexation
+# et à la requête ; 0 conserve la résolution d'origine
+TAILLE_CANONIQUE = int(os.environ.get("CBIR_TAILLE_CANONIQUE", "512"))
+
+# Décodage JPEG à résolution réduite (mise à l'échelle DCT de libjpeg)
+MODES_REDUITS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+)
+
+
+def _dimensions_jpeg(octets):
+    """Lit (hauteur, largeur) dans l'en-tête d'un JPEG sans le décoder, ou None"""
+    if octets[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 < len(octets):
+        if octets[i] != 0xFF:
+            return None
+        marqueur = octets[i + 1]
+        if marqueur == 0xFF:
+            i += 1
+            continue
+        if 0xD0 <= marqueur <= 0xD9 or marqueur == 0x01:
+            i += 2
+            continue
+        longueur = int.from_bytes(octets[i + 2:i + 4], "big")
+        # Marqueurs SOF (hors DHT, JPG et DAC)
+        if 0xC0 <= marqueur <= 0xCF and marqueur not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(octets[i + 5:i + 7], "big"), int.from_bytes(octets[i + 7:i + 9], "big")
+        i += 2 + longueur
+    return None
+
+
+def lire_image_gris(image_path, taille_canonique=None):
+    """Décode une image en niveaux de gris, ramenée à la taille canonique"""
+    taille = TAILLE_CANONIQUE if taille_canonique is None else taille_canonique
+    
+    with chronometre("decodage_image"):
+        if not taille:
+            img = cv2.imread(image_path, 0)
+        else:
+            with open(image_path, "rb") as f:
+                octets = f.read()
+            
+            # Choisir le plus fort facteur de réduction qui reste au-dessus de la taille cible
+            mode = cv2.IMREAD_GRAYSCALE
+            dimensions = _dimensions_jpeg(octets)
+            if dimensions is not None:
+                for facteur, mode_reduit in MODES_REDUITS:
+                    if max(dimensions) // facteur >= taille:
+                        mode = mode_reduit
+                        break
+            
+            img = cv2.imdecode(np.frombuffer(octets, np.uint8), mode)
+            if img is not None and max(img.shape) > taille:
+                echelle = taille / max(img.shape)
+                dimensions = (max(1, round(img.shape[1] * echelle)), max(1, round(img.shape[0] * echelle)))
+                img = cv2.resize(img, dimensions, interpolation=cv2.INTER_AREA)
+    
+    if img is None:
+        raise ValueError(f"Impossible de lire l'image: {image_path}")
+    return img
+
+
+def _image_gris(source):
+    # Les descripteurs acceptent un chemin ou une image déjà décodée
+    if isinstance(source, np.ndarray):
+        return source
+    return lire_image_gris(source)
+
 
+@chronometre_fonction("descripteur_glcm")
 def glcm(image_path):
     """Extraction des caractéristiques GLCM"""
     try:
-        img = cv2.imread(image_path, 0)
-        if img is None:
-            raise ValueError(f"Impossible de lire l'image: {image_path}")
+        img = _image_gris(image_path)
             
         co_matrice = graycomatrix(img, [1], [np.pi/2], None, symmetric=False, normed=False)
         contrast = graycoprops(co_matrice, 'contrast')[0, 0]
@@ -32,12 +141,11 @@ def glcm(image_path):
         st.error(f"Erreur lors de l'extraction GLCM: {str(e)}")
         return [0.0] * 6 
 
+@chronometre_fonction("descripteur_haralick")
 def haralik_feat(image_path):
     """Extraction des caractéristiques Haralick"""
     try:
-        img = cv2.imread(image_path, 0)
-        if img is None:
-            raise ValueError(f"Impossible de lire l'image: {image_path}")
+        img = _image_gris(image_path)
             
         features = haralick(img).mean(0).tolist()
         features = [float(x) for x in features]
@@ -46,45 +154,124 @@ def haralik_feat(image_path):
         st.error(f"Erreur lors de l'extraction Haralick: {str(e)}")
         return [0.0] * 13 
 
-def simple_bit(image_path):
-    """Remplacement simplifié du descripteur BiT"""
+# Distance taxonomique entre deux niveaux de gris (les « espèces » du descripteur BiT)
+NIVEAUX_GRIS = np.arange(256, dtype=np.float64)
+DISTANCES_TAXONOMIQUES = np.abs(NIVEAUX_GRIS[:, None] - NIVEAUX_GRIS[None, :]) / 255.0
+
+@chronometre_fonction("descripteur_bit")
+def bit_feat(image_path):
+    """Extraction du descripteur BiT (Bio-inspired Texture)
+    
+    Les niveaux de gris sont traités comme des espèces et les pixels comme des individus :
+    indices de biodiversité, de distinction taxonomique et moments statistiques sont
+    tous calculés à partir d'un unique histogramme à 256 classes.
+    """
     try:
-        img = cv2.imread(image_path, 0)
-        if img is None:
-            raise ValueError(f"Impossible de lire l'image: {image_path}")
+        img = _image_gris(image_path)
         
-        mean = np.mean(img)
-        std = np.std(img)
-        min_val = np.min(img)
-        max_val = np.max(img)
+        hist = np.bincount(img.ravel(), minlength=256).astype(np.float64)
+        n = hist.sum()
+        p = hist / n
+        presentes = hist > 0
+        richesse = np.count_nonzero(presentes)
         
-        hist = np.histogram(img, bins=10, range=(0, 256))[0]
-        hist = hist / np.sum(hist) 
+        # Indices de biodiversité
+        shannon = -np.sum(p[presentes] * np.log(p[presentes]))
+        gini_simpson = 1.0 - np.sum(p ** 2)
+        berger_parker = p.max()
+        margalef = (richesse - 1) / np.log(n) if n > 1 else 0.0
+        menhinick = richesse / np.sqrt(n)
+        u = np.sqrt(np.sum(hist ** 2))
+        mcintosh = (n - u) / (n - np.sqrt(n)) if n > 1 else 0.0
+        brillouin = (gammaln(n + 1) - np.sum(gammaln(hist + 1))) / n
         
-     
-        features = [mean, std, min_val, max_val]
-        features.extend(hist)
+        # Indices taxonomiques (sommes sur les paires d'espèces distinctes)
+        paires_individus = hist @ DISTANCES_TAXONOMIQUES @ hist
+        diversite_taxo = paires_individus / (n * (n - 1)) if n > 1 else 0.0
+        paires_distinctes = n ** 2 - np.sum(hist ** 2)
+        distinction_taxo = paires_individus / paires_distinctes if paires_distinctes > 0 else 0.0
+        if richesse > 1:
+            q = presentes.astype(np.float64)
+            paires_especes = richesse * (richesse - 1)
+            distinction_moyenne = (q @ DISTANCES_TAXONOMIQUES @ q) / paires_especes
+            variation_distinction = (q @ DISTANCES_TAXONOMIQUES ** 2 @ q) / paires_especes - distinction_moyenne ** 2
+        else:
+            distinction_moyenne = 0.0
+            variation_distinction = 0.0
+        distinction_totale = richesse * distinction_moyenne
         
-
-        if len(features) < 16:
-            skewness = np.mean(((img - mean) / std) ** 3) if std > 0 else 0
-            kurtosis = np.mean(((img - mean) / std) ** 4) if std > 0 else 0
-            features.extend([skewness, kurtosis])
-            features.extend([0.0] * (16 - len(features)))  
+        # Moments de la distribution des niveaux de gris
+        moyenne = p @ NIVEAUX_GRIS
+        ecarts = NIVEAUX_GRIS - moyenne
+        variance = p @ ecarts ** 2
+        ecart_type = np.sqrt(variance)
+        asymetrie = (p @ ecarts ** 3) / ecart_type ** 3 if ecart_type > 0 else 0.0
+        aplatissement = (p @ ecarts ** 4) / variance ** 2 if ecart_type > 0 else 0.0
         
-        return features[:16]  
+        features = [
+            shannon, gini_simpson, berger_parker, margalef, menhinick, mcintosh, brillouin,
+            diversite_taxo, distinction_taxo, distinction_moyenne, distinction_totale, variation_distinction,
+            moyenne, ecart_type, asymetrie, aplatissement
+        ]
+        features = [float(x) for x in features]
+        return features
     except Exception as e:
-        st.error(f"Erreur lors de l'extraction simple BiT: {str(e)}")
+        st.error(f"Erreur lors de l'extraction BiT: {str(e)}")
         return [0.0] * 16
 
 def concat(image_path):
     """Concaténation des trois descripteurs"""
     try:
-        return glcm(image_path) + haralik_feat(image_path) + simple_bit(image_path)
+        image_path = _image_gris(image_path)
+        return glcm(image_path) + haralik_feat(image_path) + bit_feat(image_path)
     except Exception as e:
         st.error(f"Erreur lors de la concaténation des descripteurs: {str(e)}")
         return [0.0] * 35 
 
+# Pool persistant pour l'extraction des descripteurs d'une image requête, partagé par toutes les
+# sessions du processus et dimensionné sur le nombre de CPU
+NB_WORKERS_DESCRIPTEURS = int(os.environ.get("CBIR_DESCRIPTEURS_WORKERS", str(os.cpu_count() or 1)))
+_pool_descripteurs = ThreadPoolExecutor(max_workers=NB_WORKERS_DESCRIPTEURS, thread_name_prefix="cbir-descripteurs")
+_verrou_pool = threading.Lock()
+_places_occupees = 0
+
+def _reserver_pool(places):
+    """Réserve des places libres du pool ; False s'il n'en reste pas assez (rien n'est mis en file)"""
+    global _places_occupees
+    with _verrou_pool:
+        if _places_occupees + places > NB_WORKERS_DESCRIPTEURS:
+            return False
+        _places_occupees += places
+        return True
+
+def _liberer_pool(places):
+    global _places_occupees
+    with _verrou_pool:
+        _places_occupees -= places
+
+def concat_parallele(image_path):
+    """Concaténation des trois descripteurs, calculés en parallèle sur une image décodée une seule fois
+    
+    Quand le pool est occupé par d'autres requêtes, les descripteurs sont calculés séquentiellement
+    sur le thread appelant, comme `concat`.
+    """
+    try:
+        img = _image_gris(image_path)
+        if not _reserver_pool(2):
+            return glcm(img) + haralik_feat(img) + bit_feat(img)
+        
+        try:
+            # OpenCV, scikit-image et mahotas passent l'essentiel du temps en code natif ;
+            # le thread appelant calcule Haralick, le plus coûteux
+            taches = [_pool_descripteurs.submit(descripteur, img) for descripteur in (glcm, bit_feat)]
+            caracteristiques_haralick = haralik_feat(img)
+            return taches[0].result() + caracteristiques_haralick + taches[1].result()
+        finally:
+            _liberer_pool(2)
+    except Exception as e:
+        st.error(f"Erreur lors de la concaténation des descripteurs: {str(e)}")
+        return [0.0] * 35
+
 # Fonctions de calcul de distance
 def manhattan_distance(v1, v2):
     """Distance de Manhattan"""
@@ -116,30 +303,335 @@ def recherche_images(bdd_signature, caracteristique_requete, distance_type, K):
     """Recherche les K images les plus similaires"""
     img_similaire = []
     
-    for instance in bdd_signature:
-        carac, label, img_chemin = instance[:-2], instance[-2], instance[-1]
+    with chronometre("calcul_distances"):
+        for instance in bdd_signature:
+            carac, label, img_chemin = instance[:-2], instance[-2], instance[-1]
+            
+            if distance_type == 'manhattan':
+                dist = manhattan_distance(caracteristique_requete, carac)
+            elif distance_type == 'euclidean':
+                dist = euclidean_distance(caracteristique_requete, carac)
+            elif distance_type == 'chebyshev':
+                dist = chebyshev_distance(caracteristique_requete, carac)
+            elif distance_type == 'canberra':
+                dist = canberra_distance(caracteristique_requete, carac)
+            else:
+                dist = euclidean_distance(caracteristique_requete, carac)  # Par défaut
+            
+            img_similaire.append((img_chemin, dist, label))
+    
+    with chronometre("selection_top_k"):
+        img_similaire.sort(key=lambda x: x[1])
+    return img_similaire[:K]
+
+# Correspondance entre les distances de l'interface et les métriques de scipy
+METRIQUES_SCIPY = {
+    'euclidean': 'euclidean',
+    'manhattan': 'cityblock',
+    'chebyshev': 'chebyshev',
+    'canberra': 'canberra'
+}
+
+def construire_store(brut):
+    """Regroupe par classe un tableau de signatures (caractéristiques, classe, chemin)"""
+    labels = brut[:, -2].astype(str)
+    chemins = brut[:, -1].astype(str)
+    
+    # Regrouper les lignes par classe pour que chaque classe soit une tranche contiguë
+    ordre = np.lexsort((chemins, labels))
+    caracteristiques = np.ascontiguousarray(brut[ordre, :-2].astype(np.float64))
+    labels = labels[ordre]
+    chemins = chemins[ordre]
+    
+    classes, debuts, comptes = np.unique(labels, return_index=True, return_counts=True)
+    partitions = {str(c): (int(d), int(d + n)) for c, d, n in zip(classes, debuts, comptes)}
+    
+    for tableau in (caracteristiques, labels, chemins):
+        tableau.flags.writeable = False
+    
+    return {
+        'caracteristiques': caracteristiques,
+        'labels': labels,
+        'chemins': chemins,
+        'partitions': partitions
+    }
+
+def chemin_metadonnees(signature_file):
+    """Fichier JSON décrivant les conditions d'extraction d'un fichier de signatures"""
+    return os.path.splitext(signature_file)[0] + ".json"
+
+def metadonnees_attendues(descripteur):
+    """Conditions d'extraction des signatures compatibles avec les requêtes de ce processus"""
+    return {'taille_canonique': TAILLE_CANONIQUE, 'version_descripteur': VERSIONS_DESCRIPTEURS.get(descripteur)}
+
+@lru_cache(maxsize=8)
+def _charger_signatures_cache(signature_file, mtime_ns):
+    store = construire_store(np.load(signature_file))
+    
+    # Le JSON est écrit avant le remplacement du .npy : il est à jour dès que le mtime change
+    try:
+        with open(chemin_metadonnees(signature_file), encoding="utf-8") as f:
+            store['metadonnees'] = json.load(f)
+    except (OSError, ValueError):
+        store['metadonnees'] = None
+    return store
+
+def incompatibilite_signatures(signature_file):
+    """Message décrivant pourquoi un fichier de signatures ne correspond pas aux requêtes, ou None"""
+    metadonnees = _charger_signatures_cache(signature_file, os.stat(signature_file).st_mtime_ns)['metadonnees']
+    if metadonnees is None:
+        return f"{signature_file}: conditions d'extraction inconnues, signatures à réextraire"
+    
+    descripteur = os.path.basename(signature_file)[len("Signatures"):-len(".npy")]
+    for cle, attendu in metadonnees_attendues(descripteur).items():
+        if metadonnees.get(cle) != attendu:
+            return f"{signature_file}: {cle} = {metadonnees.get(cle)} au lieu de {attendu}, signatures à réextraire"
+    return None
+
+def charger_signatures(signature_file, verifier=True):
+    """Charge un fichier de signatures regroupé par classe (cache invalidé par mtime)
+    
+    Lève ValueError si les signatures n'ont pas été extraites comme les requêtes, sauf avec `verifier=False`.
+    """
+    with chronometre("chargement_signatures"):
+        store = _charger_signatures_cache(signature_file, os.stat(signature_file).st_mtime_ns)
+    if verifier:
+        probleme = incompatibilite_signatures(signature_file)
+        if probleme is not None:
+            raise ValueError(probleme)
+    return store
+
+def calculer_distances(requetes, matrice, distance_type):
+    """Distances entre une ou plusieurs requêtes et toutes les lignes d'une matrice"""
+    metrique = METRIQUES_SCIPY.get(distance_type, 'euclidean')
+    requetes = np.atleast_2d(np.asarray(requetes, dtype=np.float64))
+    return distance.cdist(requetes, matrice, metrique)
+
+def selection_top_k(distances, K):
+    """Indices des K plus petites distances, triés par distance croissante"""
+    K = min(K, len(distances))
+    if K <= 0:
+        return np.empty(0, dtype=np.intp)
+    candidats = np.argpartition(distances, K - 1)[:K]
+    return candidats[np.argsort(distances[candidats], kind='stable')]
+
+def partitions_selectionnees(store, classes_incluses=None, classes_exclues=None):
+    """Tranches (début, fin) des classes retenues par le filtre"""
+    classes = set(store['partitions'])
+    if classes_incluses:
+        classes &= set(classes_incluses)
+    if classes_exclues:
+        classes -= set(classes_exclues)
+    return [store['partitions'][c] for c in sorted(classes)]
+
+def recherche_par_classes(store, caracteristique_requete, distance_type, K,
+                          classes_incluses=None, classes_exclues=None):
+    """Recherche les K images les plus similaires parmi les classes retenues
+    
+    Renvoie les résultats (chemin, distance, label) et le nombre de résultats par classe.
+    """
+    tranches = partitions_selectionnees(store, classes_incluses, classes_exclues)
+    if not tranches:
+        return [], {}
+    
+    matrice = store['caracteristiques']
+    with chronometre("calcul_distances"):
+        distances = np.concatenate([
+            calculer_distances(caracteristique_requete, matrice[debut:fin], distance_type)[0]
+            for debut, fin in tranches
+        ])
+    
+    with chronometre("selection_top_k"):
+        indices_locaux = selection_top_k(distances, K)
+        indices = np.concatenate([np.arange(debut, fin) for debut, fin in tranches])[indices_locaux]
+    
+    resultats = [
+        (store['chemins'][i], float(d), store['labels'][i])
+        for i, d in zip(indices, distances[indices_locaux])
+    ]
+    facettes = dict(Counter(label for _, _, label in resultats).most_common())
+    return resultats, facettes
+
+# Distances insensibles à l'échelle de chaque caractéristique : la passe grossière peut les réduire
+DISTANCES_INVARIANTES_ECHELLE = {'canberra'}
+
+@lru_cache(maxsize=16)
+def _pca_cache(signature_file, mtime_ns, dimensions, reduire):
+    caracteristiques = _charger_signatures_cache(signature_file, mtime_ns)['caracteristiques']
+    moyenne = caracteristiques.mean(axis=0)
+    ecart = caracteristiques.std(axis=0) if reduire else np.ones(caracteristiques.shape[1])
+    ecart[ecart == 0] = 1.0
+    centrees = (caracteristiques - moyenne) / ecart
+    _, _, vt = np.linalg.svd(centrees, full_matrices=False)
+    composantes = vt[:dimensions].T
+    return moyenne, ecart, composantes, np.ascontiguousarray(centrees @ composantes)
+
+def representation_pca(signature_file, caracteristique_requete, distance_type, dimensions=8):
+    """Représentation grossière : projection sur les premières composantes principales
+    
+    Les caractéristiques sont seulement centrées, dans la géométrie du reclassement exact (la distance
+    euclidienne projetée minore alors la distance exacte) ; elles ne sont réduites que pour les distances
+    insensibles à l'échelle de chaque caractéristique.
+    """
+    reduire = distance_type in DISTANCES_INVARIANTES_ECHELLE
+    moyenne, ecart, composantes, projetees = _pca_cache(
+        signature_file, os.stat(signature_file).st_mtime_ns, dimensions, reduire
+    )
+    requete = (np.asarray(caracteristique_requete, dtype=np.float64) - moyenne) / ecart @ composantes
+    return {'vecteurs': projetees, 'requete': requete, 'distance': 'euclidean'}
+
+def representation_glcm(store, store_glcm, requete_glcm, distance_type):
+    """Représentation grossière : store GLCM (6 dimensions), aligné ligne à ligne sur le store exact"""
+    if not np.array_equal(store['chemins'], store_glcm['chemins']):
+        raise ValueError("Les signatures GLCM et les signatures exactes ne couvrent pas les mêmes images")
+    return {'vecteurs': store_glcm['caracteristiques'], 'requete': requete_glcm, 'distance': distance_type}
+
+def recherche_cascade(store, caracteristique_requete, distance_type, K, M, representation,
+                      classes_incluses=None, classes_exclues=None):
+    """Recherche en deux temps : M candidats par une passe grossière, puis reclassement exact des K meilleurs"""
+    tranches = partitions_selectionnees(store, classes_incluses, classes_exclues)
+    if not tranches:
+        return [], {}
+    
+    with chronometre("cascade_passe_grossiere"):
+        vecteurs = representation['vecteurs']
+        distances = np.concatenate([
+            calculer_distances(representation['requete'], vecteurs[debut:fin], representation['distance'])[0]
+            for debut, fin in tranches
+        ])
+        indices = np.concatenate([np.arange(debut, fin) for debut, fin in tranches])
+        candidats = indices[selection_top_k(distances, max(M, K))]
+    
+    with chronometre("cascade_reclassement"):
+        exactes = calculer_distances(caracteristique_requete, store['caracteristiques'][candidats], distance_type)[0]
+        meilleurs = selection_top_k(exactes, K)
+    
+    resultats = [
+        (store['chemins'][i], float(d), store['labels'][i])
+        for i, d in zip(candidats[meilleurs], exactes[meilleurs])
+    ]
+    facettes = dict(Counter(label for _, _, label in resultats).most_common())
+    return resultats, facettes
+
+def rappel_cascade(resultats, resultats_exhaustifs):
+    """Part des résultats de la recherche exhaustive retrouvés par la cascade"""
+    if not resultats_exhaustifs:
+        return 1.0
+    trouves = {chemin for chemin, _, _ in resultats}
+    return sum(1 for chemin, _, _ in resultats_exhaustifs if chemin in trouves) / len(resultats_exhaustifs)
+
+def valider_signatures():
+    """Charge et vérifie tous les fichiers de signatures présents
+    
+    Renvoie le nombre d'images de chaque store, ou la raison pour laquelle il doit être réextrait ;
+    lève ValueError si un store est incohérent.
+    """
+    stores = {}
+    for descripteur, dimension in DIMENSIONS.items():
+        signatures_file = os.path.join(SIGNATURES_PATH, f"Signatures{descripteur}.npy")
+        if not os.path.exists(signatures_file):
+            continue
         
-        if distance_type == 'manhattan':
-            dist = manhattan_distance(caracteristique_requete, carac)
-        elif distance_type == 'euclidean':
-            dist = euclidean_distance(caracteristique_requete, carac)
-        elif distance_type == 'chebyshev':
-            dist = chebyshev_distance(caracteristique_requete, carac)
-        elif distance_type == 'canberra':
-            dist = canberra_distance(caracteristique_requete, carac)
-        else:
-            dist = euclidean_distance(caracteristique_requete, carac)  # Par défaut
+        store = charger_signatures(signatures_file, verifier=False)
+        caracteristiques = store['caracteristiques']
+        if caracteristiques.ndim != 2 or caracteristiques.shape[1] != dimension:
+            raise ValueError(f"{signatures_file}: {caracteristiques.shape[-1]} caractéristiques au lieu de {dimension}")
+        if not np.isfinite(caracteristiques).all():
+            raise ValueError(f"{signatures_file}: valeurs non finies")
         
-        img_similaire.append((img_chemin, dist, label))
+        # Un store à réextraire est signalé sans bloquer le démarrage : la recherche le refuse
+        probleme = incompatibilite_signatures(signatures_file)
+        if probleme is not None:
+            logger.warning(probleme)
+            stores[descripteur] = probleme
+        else:
+            stores[descripteur] = len(caracteristiques)
+    return stores
+
+def rechauffer_recherche():
+    """Exécute une extraction et une recherche factices pour initialiser descripteurs et caches"""
+    image = np.random.default_rng(0).integers(0, 256, (64, 64), dtype=np.uint8)
+    caracteristiques = concat_parallele(image)
     
-    img_similaire.sort(key=lambda x: x[1])
-    return img_similaire[:K]
+    signatures_file = os.path.join(SIGNATURES_PATH, "SignaturesConcat.npy")
+    if os.path.exists(signatures_file):
+        recherche_par_classes(charger_signatures(signatures_file, verifier=False), caracteristiques, 'euclidean', 1)
+    return len(caracteristiques)
 
-def extraction_signatures(chemin_dossier, type_descripteur):
-    """Extrait les signatures pour toutes les images du dataset"""
-    st.info(f"Extraction des signatures {type_descripteur} en cours...")
-    progress_bar = st.progress(0)
+def chemin_graphe(descripteur, distance_type):
+    """Fichier du graphe des K plus proches voisins d'un descripteur et d'une distance"""
+    return os.path.join(SIGNATURES_PATH, f"Voisins{descripteur}_{distance_type}.npz")
+
+@lru_cache(maxsize=16)
+def _charger_npz_cache(fichier, mtime_ns):
+    with np.load(fichier) as donnees:
+        return {cle: donnees[cle] for cle in donnees.files}
+
+def _charger_npz(fichier):
+    try:
+        mtime_ns = os.stat(fichier).st_mtime_ns
+    except OSError:
+        return None
+    return _charger_npz_cache(fichier, mtime_ns)
+
+@lru_cache(maxsize=8)
+def _tri_chemins(signature_file, mtime_ns):
+    # Ordre des chemins du store, pour retrouver une image par recherche dichotomique
+    return np.argsort(_charger_signatures_cache(signature_file, mtime_ns)['chemins'], kind='stable')
+
+def voisins_precalcules(descripteur, distance_type, relative_path, K, inclure_requete=False):
+    """Renvoie les K voisins précalculés d'une image indexée, ou None si le graphe ne peut pas répondre
+
+    Le graphe exclut l'image elle-même ; avec `inclure_requete`, elle est placée en tête (distance nulle)
+    comme dans une recherche exhaustive.
+    """
+    nb_voisins = K - 1 if inclure_requete else K
+    graphe = _charger_npz(chemin_graphe(descripteur, distance_type))
+    if graphe is None or nb_voisins > graphe['voisins'].shape[1]:
+        return None
     
+    # Un graphe construit sur une ancienne version des signatures n'est pas utilisé ; sinon ses lignes
+    # suivent l'ordre du store, qui fournit chemins et classes
+    signatures_file = os.path.join(SIGNATURES_PATH, f"Signatures{descripteur}.npy")
+    if not os.path.exists(signatures_file):
+        return None
+    mtime_ns = os.stat(signatures_file).st_mtime_ns
+    if mtime_ns != int(graphe['source_mtime_ns']):
+        return None
+    
+    store = _charger_signatures_cache(signatures_file, mtime_ns)
+    chemins = store['chemins']
+    tri_chemins = _tri_chemins(signatures_file, mtime_ns)
+    position = np.searchsorted(chemins, relative_path, sorter=tri_chemins)
+    if position >= len(chemins) or chemins[tri_chemins[position]] != relative_path:
+        return None
+    
+    i = tri_chemins[position]
+    resultats = [(chemins[i], 0.0, store['labels'][i])] if inclure_requete else []
+    return resultats + [
+        (chemins[v], float(d), store['labels'][v])
+        for v, d in zip(graphe['voisins'][i, :nb_voisins], graphe['distances'][i, :nb_voisins])
+    ]
+
+def empreinte_image(octets):
+    """Empreinte du contenu d'une image, pour reconnaître une image déjà indexée"""
+    return hashlib.sha1(octets).hexdigest()
+
+def chemin_par_empreinte(octets):
+    """Chemin relatif de l'image indexée ayant le même contenu, ou None"""
+    index = _charger_npz(os.path.join(SIGNATURES_PATH, "Empreintes.npz"))
+    if index is None:
+        return None
+    
+    empreinte = empreinte_image(octets)
+    position = np.searchsorted(index['empreintes'], empreinte)
+    if position < len(index['empreintes']) and index['empreintes'][position] == empreinte:
+        return str(index['chemins'][position])
+    return None
+
+def calculer_signatures(chemin_dossier, type_descripteur, progression=None, avertissement=None,
+                        taille_canonique=None):
+    """Calcule les signatures de toutes les images du dataset"""
     list_carac = []
     total_files = 0
     processed_files = 0
@@ -157,30 +649,95 @@ def extraction_signatures(chemin_dossier, type_descripteur):
                 path = os.path.join(root, file)
                 
                 try:
+                    img = lire_image_gris(path, taille_canonique)
                     if type_descripteur == 'glcm':
-                        caracteristiques = glcm(path)
+                        caracteristiques = glcm(img)
                     elif type_descripteur == 'haralick':
-                        caracteristiques = haralik_feat(path)
+                        caracteristiques = haralik_feat(img)
                     elif type_descripteur == 'bit':
-                        caracteristiques = simple_bit(path)
+                        caracteristiques = bit_feat(img)
                     else:  # 'concat' par défaut
-                        caracteristiques = concat(path)
+                        caracteristiques = concat(img)
                     
                     class_name = os.path.dirname(relative_path)
                     list_carac.append(caracteristiques + [class_name, relative_path])
                 except Exception as e:
-                    st.warning(f"Erreur lors du traitement de {path}: {str(e)}")
+                    if avertissement is not None:
+                        avertissement(f"Erreur lors du traitement de {path}: {str(e)}")
                 
                 processed_files += 1
-                progress_bar.progress(processed_files / total_files if total_files > 0 else 0)
+                if progression is not None:
+                    progression(processed_files / total_files if total_files > 0 else 0)
     
-    Signatures = np.array(list_carac)
+    return np.array(list_carac), processed_files
+
+def enregistrer_signatures(Signatures, type_descripteur):
+    """Remplace atomiquement le fichier de signatures d'un descripteur et ses métadonnées"""
     signature_file = os.path.join(SIGNATURES_PATH, f"Signatures{type_descripteur.capitalize()}.npy")
-    np.save(signature_file, Signatures)
+    
+    # Les lecteurs voient l'ancien ou le nouveau fichier, jamais un fichier partiel
+    suffixe = f"{os.getpid()}.{threading.get_ident()}.tmp"
+    temporaire = f"{chemin_metadonnees(signature_file)}.{suffixe}"
+    with open(temporaire, "w", encoding="utf-8") as f:
+        json.dump(metadonnees_attendues(type_descripteur.capitalize()), f)
+    os.replace(temporaire, chemin_metadonnees(signature_file))
+    
+    temporaire = f"{signature_file}.{suffixe}.npy"
+    np.save(temporaire, Signatures)
+    os.replace(temporaire, signature_file)
+    return signature_file
+
+def extraction_signatures(chemin_dossier, type_descripteur):
+    """Extrait les signatures pour toutes les images du dataset"""
+    st.info(f"Extraction des signatures {type_descripteur} en cours...")
+    progress_bar = st.progress(0)
+    
+    Signatures, processed_files = calculer_signatures(
+        chemin_dossier, type_descripteur, progress_bar.progress, st.warning
+    )
+    signature_file = enregistrer_signatures(Signatures, type_descripteur)
     
     st.success(f"Extraction terminée. {processed_files} images traitées.")
     return signature_file
 
+def _travail_extraction(chemin_dossier, type_descripteur, progression):
+    echecs = []
+    
+    def avertissement(message):
+        # Sans interface pour l'afficher : journalisé et conservé dans l'état du travail
+        logger.warning(message)
+        echecs.append(message)
+    
+    Signatures, processed_files = calculer_signatures(chemin_dossier, type_descripteur, progression, avertissement)
+    enregistrer_signatures(Signatures, type_descripteur)
+    return {'images': processed_files - len(echecs), 'echecs': echecs}
+
+def soumettre_extractions(chemin_dossier):
+    """Met en file l'extraction de toutes les signatures puis la génération des miniatures"""
+    for desc_type in ['glcm', 'haralick', 'bit', 'concat']:
+        soumettre_travail(f"signatures_{desc_type}", _travail_extraction, chemin_dossier, desc_type)
+    soumettre_travail("miniatures", construire_miniatures, chemin_dossier)
+
+def afficher_travaux():
+    """Affiche l'état des travaux d'extraction en arrière-plan"""
+    travaux = etat_travaux()
+    for cle, travail in sorted(travaux.items()):
+        if travail['statut'] == 'erreur':
+            st.error(f"{cle}: échec ({travail['erreur']})")
+        elif travail['statut'] == 'termine' and isinstance(travail['resultat'], dict) and travail['resultat']['echecs']:
+            echecs = travail['resultat']['echecs']
+            st.warning(f"{cle}: terminé ({travail['resultat']['images']} images, {len(echecs)} en échec)")
+            with st.expander(f"Images non indexées ({cle})"):
+                st.write("\n".join(f"- {message}" for message in echecs[:50]))
+                if len(echecs) > 50:
+                    st.write(f"... et {len(echecs) - 50} autres")
+        elif travail['statut'] == 'termine':
+            resultat = travail['resultat']
+            st.success(f"{cle}: terminé ({resultat['images'] if isinstance(resultat, dict) else resultat})")
+        else:
+            st.progress(travail['progression'], text=f"{cle}: {travail['statut'].replace('_', ' ')}")
+    return any(t['statut'] in ('en_attente', 'en_cours') for t in travaux.values())
+
 # Fonction pour télécharger une image temporaire
 def save_uploaded_image(uploaded_file):
     """Sauvegarde une image téléversée dans un répertoire temporaire"""
@@ -197,6 +754,40 @@ def save_uploaded_image(uploaded_file):
         return file_path
     return None
 
+def _naviguer(img_path, descripteur, distance_type, k_images):
+    st.session_state.navigation = (img_path, descripteur, distance_type, k_images)
+
+def afficher_resultats(results, conteneur, descripteur, distance_type, k_images):
+    """Affiche la grille des résultats avec un lien « plus comme ceci » par vignette"""
+    with conteneur, chronometre("rendu_resultats"):
+        st.subheader("Résultats de la recherche")
+        
+        # Créer une grille pour afficher les résultats
+        n_cols = 3
+        n_rows = (len(results) + n_cols - 1) // n_cols
+        
+        for row in range(n_rows):
+            cols = st.columns(n_cols)
+            for col in range(n_cols):
+                idx = row * n_cols + col
+                if idx < len(results):
+                    img_path, distance, label = results[idx]
+                    
+                    try:
+                        miniature = obtenir_miniature(DATASET_PATH, img_path)
+                        if miniature is not None:
+                            cols[col].image(miniature, caption=f"{label} (d={distance:.4f})", width=150)
+                        else:
+                            cols[col].error(f"Impossible de charger l'image: {img_path}")
+                    except Exception as e:
+                        cols[col].error(f"Erreur: {str(e)}")
+                    
+                    # Le callback s'exécute avant la prochaine exécution du script
+                    cols[col].button(
+                        "Plus comme ceci", key=f"plus_{idx}_{img_path}",
+                        on_click=_naviguer, args=(img_path, descripteur, distance_type, k_images)
+                    )
+
 def cbir_page():
     """Page de recherche d'images basée sur le contenu"""
     st.header("Recherche d'Images basée sur le Contenu (CBIR)")
@@ -212,21 +803,61 @@ def cbir_page():
     missing_signatures = [name for name, path in signatures_files.items() 
                           if not os.path.exists(path)]
     
-    # Afficher un avertissement si des signatures sont manquantes
+    # Signatures extraites à une autre taille canonique ou par une autre version d'un descripteur
+    stale_signatures = [name for name, path in signatures_files.items()
+                        if os.path.exists(path) and incompatibilite_signatures(path) is not None]
+    
+    # Afficher un avertissement si des signatures sont manquantes ou à réextraire
     if missing_signatures:
         st.warning(f"Les signatures suivantes n'ont pas été extraites: {', '.join(missing_signatures)}")
-        
-        with st.expander("Extraction des signatures"):
-            st.write("Vous devez extraire les signatures avant de pouvoir utiliser la recherche CBIR.")
+    if stale_signatures:
+        st.warning(f"Les signatures suivantes doivent être réextraites: {', '.join(stale_signatures)}")
+    
+    if missing_signatures or stale_signatures or etat_travaux():
+        with st.expander("Extraction des signatures", expanded=bool(etat_travaux() or stale_signatures)):
+            if missing_signatures or stale_signatures:
+                st.write("Vous devez extraire les signatures avant de pouvoir utiliser la recherche CBIR.")
             
+            # L'extraction tourne en arrière-plan : la page reste utilisable pendant ce temps
             if st.button("Extraire toutes les signatures"):
-                for desc_type in ['glcm', 'haralick', 'bit', 'concat']:
-                    extraction_signatures(DATASET_PATH, desc_type)
-                st.success("Toutes les signatures ont été extraites.")
+                soumettre_extractions(DATASET_PATH)
+            
+            if afficher_travaux() and st.button("Actualiser l'état de l'extraction"):
                 st.rerun()
     
     col1, col2 = st.columns([1, 2])
     
+    # Navigation « plus comme ceci » depuis une vignette de résultat
+    navigation = st.session_state.get('navigation')
+    if navigation is not None:
+        img_path, descripteur, distance_type, k_images = navigation
+        with col1:
+            st.subheader("Image de référence")
+            miniature = obtenir_miniature(DATASET_PATH, img_path)
+            if miniature is not None:
+                st.image(miniature, caption=img_path)
+            if st.button("Revenir à la recherche"):
+                st.session_state.navigation = None
+                st.rerun()
+        
+        results = voisins_precalcules(DESCRIPTEURS[descripteur], distance_type, img_path, k_images)
+        if results is None:
+            # Graphe absent ou obsolète : relancer la recherche avec la signature déjà indexée
+            try:
+                store = charger_signatures(os.path.join(SIGNATURES_PATH, f"Signatures{DESCRIPTEURS[descripteur]}.npy"))
+            except ValueError as e:
+                st.error(str(e))
+                return
+            ligne = np.flatnonzero(store['chemins'] == img_path)
+            if len(ligne) == 0:
+                st.error(f"L'image {img_path} n'est pas indexée.")
+                return
+            results, _ = recherche_par_classes(store, store['caracteristiques'][ligne[0]], distance_type, k_images + 1)
+            results = [r for r in results if r[0] != img_path][:k_images]
+        
+        afficher_resultats(results, col2, descripteur, distance_type, k_images)
+        return
+    
     with col1:
         st.subheader("Paramètres de recherche")
         
@@ -241,7 +872,7 @@ def cbir_page():
             # Options de recherche
             descripteur = st.selectbox(
                 "Descripteur à utiliser",
-                ["GLCM", "Haralick", "BiT", "Concaténation"],
+                list(DESCRIPTEURS),
                 index=3  # Concaténation par défaut
             )
             
@@ -253,65 +884,101 @@ def cbir_page():
             
             k_images = st.slider("Nombre d'images similaires (K)", min_value=1, max_value=20, value=10)
             
+            # Restreindre la recherche à certaines classes du dataset
+            classes_incluses = []
+            classes_exclues = []
+            store_classes = next((path for path in signatures_files.values() if os.path.exists(path)), None)
+            if store_classes is not None:
+                classes_disponibles = list(charger_signatures(store_classes, verifier=False)['partitions'])
+                classes_incluses = st.multiselect("Limiter aux classes", classes_disponibles)
+                classes_exclues = st.multiselect("Exclure les classes", classes_disponibles)
+            
+            # Recherche en cascade : passe grossière sur M candidats puis reclassement exact
+            cascade = st.checkbox("Recherche en cascade")
+            if cascade:
+                representation_grossiere = st.selectbox("Passe grossière", ["ACP (8 dimensions)", "GLCM"])
+                m_candidats = st.slider("Nombre de candidats (M)", min_value=20, max_value=2000, value=200, step=20)
+                mesurer_rappel = st.checkbox("Mesurer le rappel par rapport à la recherche exhaustive")
+            
             # Bouton de recherche
             if st.button("Rechercher des images similaires"):
                 # Déterminer le fichier de signatures à utiliser
-                desc_map = {
-                    "GLCM": "Glcm",
-                    "Haralick": "Haralick",
-                    "BiT": "Bit",
-                    "Concaténation": "Concat"
-                }
-                
-                signatures_file = os.path.join(SIGNATURES_PATH, f"Signatures{desc_map[descripteur]}.npy")
+                signatures_file = os.path.join(SIGNATURES_PATH, f"Signatures{DESCRIPTEURS[descripteur]}.npy")
                 
                 if not os.path.exists(signatures_file):
                     st.error(f"Le fichier de signatures {signatures_file} n'existe pas.")
+                elif incompatibilite_signatures(signatures_file) is not None:
+                    # Signatures extraites à une autre résolution ou par une autre version du descripteur
+                    st.error(incompatibilite_signatures(signatures_file))
                 else:
-                    # Charger les signatures
-                    signatures = np.load(signatures_file)
+                    results = None
+                    facettes = None
                     
-                    # Extraire les caractéristiques de l'image requête
-                    if descripteur == "GLCM":
-                        requete_features = glcm(image_path)
-                    elif descripteur == "Haralick":
-                        requete_features = haralik_feat(image_path)
-                    elif descripteur == "BiT":
-                        requete_features = simple_bit(image_path)
-                    else:  # Concaténation par défaut
-                        requete_features = concat(image_path)
+                    # Une image déjà indexée se contente d'une lecture du graphe des voisins ;
+                    # elle figure en tête des résultats, comme dans la recherche exhaustive
+                    if not classes_incluses and not classes_exclues:
+                        chemin_connu = chemin_par_empreinte(uploaded_file.getvalue())
+                        if chemin_connu is not None:
+                            results = voisins_precalcules(
+                                DESCRIPTEURS[descripteur], distance_type, chemin_connu, k_images, inclure_requete=True
+                            )
+                            if results is not None:
+                                facettes = dict(Counter(label for _, _, label in results).most_common())
                     
-                    # Rechercher les images similaires
-                    results = recherche_images(signatures, requete_features, distance_type, k_images)
+                    if results is None:
+                        # Charger les signatures
+                        signatures = charger_signatures(signatures_file)
+                        
+                        # Extraire les caractéristiques de l'image requête
+                        if descripteur == "GLCM":
+                            requete_features = glcm(image_path)
+                        elif descripteur == "Haralick":
+                            requete_features = haralik_feat(image_path)
+                        elif descripteur == "BiT":
+                            requete_features = bit_feat(image_path)
+                        else:  # Concaténation par défaut
+                            requete_features = concat_parallele(image_path)
+                        
+                        # Rechercher les images similaires
+                        results = None
+                        if cascade:
+                            try:
+                                if representation_grossiere == "GLCM":
+                                    store_glcm = charger_signatures(os.path.join(SIGNATURES_PATH, "SignaturesGlcm.npy"))
+                                    # Les 6 premières caractéristiques de Concat sont celles de GLCM
+                                    requete_glcm = requete_features[:6] if descripteur == "Concaténation" else glcm(image_path)
+                                    representation = representation_glcm(signatures, store_glcm, requete_glcm, distance_type)
+                                else:
+                                    representation = representation_pca(signatures_file, requete_features, distance_type)
+                                
+                                results, facettes = recherche_cascade(
+                                    signatures, requete_features, distance_type, k_images, m_candidats,
+                                    representation, classes_incluses, classes_exclues
+                                )
+                            except (OSError, ValueError) as e:
+                                st.warning(f"Recherche en cascade impossible ({str(e)}), recherche exhaustive utilisée.")
+                        
+                        if results is None:
+                            results, facettes = recherche_par_classes(
+                                signatures, requete_features, distance_type, k_images,
+                                classes_incluses, classes_exclues
+                            )
+                        elif mesurer_rappel:
+                            exhaustifs, _ = recherche_par_classes(
+                                signatures, requete_features, distance_type, k_images,
+                                classes_incluses, classes_exclues
+                            )
+                            st.info(f"Rappel de la cascade: {rappel_cascade(results, exhaustifs):.0%}")
                     
                     # Afficher les résultats
                     st.success(f"{len(results)} images similaires trouvées!")
+                    if facettes:
+                        st.write("Répartition par classe: " + ", ".join(
+                            f"{classe or '(racine)'} ({nombre})" for classe, nombre in facettes.items()
+                        ))
                     
                     # Afficher les résultats dans la colonne de droite
-                    with col2:
-                        st.subheader("Résultats de la recherche")
-                        
-                        # Créer une grille pour afficher les résultats
-                        n_cols = 3
-                        n_rows = (len(results) + n_cols - 1) // n_cols
-                        
-                        for row in range(n_rows):
-                            cols = st.columns(n_cols)
-                            for col in range(n_cols):
-                                idx = row * n_cols + col
-                                if idx < len(results):
-                                    img_path, distance, label = results[idx]
-                                    full_path = os.path.join(DATASET_PATH, img_path)
-                                    
-                                    try:
-                                        img = cv2.imread(full_path)
-                                        if img is not None:
-                                            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                                            cols[col].image(img, caption=f"{label} (d={distance:.4f})", width=150)
-                                        else:
-                                            cols[col].error(f"Impossible de charger l'image: {img_path}")
-                                    except Exception as e:
-                                        cols[col].error(f"Erreur: {str(e)}")
+                    afficher_resultats(results, col2, descripteur, distance_type, k_images)
         else:
             with col2:
                 st.info("Téléversez une image et configurez les paramètres de recherche pour trouver des images similaires.")
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""Évaluation leave-one-out des combinaisons descripteur × distance
+
+Chaque image indexée sert tour à tour de requête contre le reste de sa base de
+signatures ; les images de la même classe (`class_name`) sont les pertinentes.
+
+    python evaluation.py --k 10 --bloc 128 --json rapport.json
+
+Avec `--tailles`, les signatures sont réextraites du dataset pour chaque taille
+canonique afin de mesurer l'effet de la réduction de résolution (0 = taille d'origine) :
+
+    python evaluation.py --tailles 0 256 512
+
+Avec `--cascade M`, chaque store est aussi interrogé en cascade (M candidats) et
+comparé à la recherche exhaustive : rappel moyen et temps par requête.
+
+    python evaluation.py --cascade 200 --grossier pca
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+
+from cbir_functions import (
+    DATASET_PATH, SIGNATURES_PATH, METRIQUES_SCIPY,
+    calculer_signatures, charger_signatures, construire_store, calculer_distances, selection_top_k,
+    recherche_par_classes, recherche_cascade, rappel_cascade, representation_pca, representation_glcm
+)
+
+
+def blocs_distances(matrice, distance_type, taille_bloc):
+    """Parcourt la matrice des distances toutes paires par blocs de lignes"""
+    for debut in range(0, len(matrice), taille_bloc):
+        fin = min(debut + taille_bloc, len(matrice))
+        yield debut, calculer_distances(matrice[debut:fin], matrice, distance_type)
+
+
+def evaluer_store(store, distance_type, K, taille_bloc):
+    """Calcule precision@K, mAP et le rappel@K par classe en leave-one-out"""
+    matrice = store['caracteristiques']
+    labels = store['labels']
+    partitions = store['partitions']
+    n = len(matrice)
+
+    precisions = np.zeros(n)
+    average_precisions = np.zeros(n)
+    rappels = np.zeros(n)
+    pertinents_existent = np.zeros(n, dtype=bool)
+
+    debut_chrono = time.perf_counter()
+    for debut_bloc, distances in blocs_distances(matrice, distance_type, taille_bloc):
+        for j, ligne in enumerate(distances):
+            i = debut_bloc + j
+            debut, fin = partitions[labels[i]]
+
+            # Exclure la requête de sa propre liste de résultats
+            ligne[i] = np.inf
+            pertinentes = np.sort(np.delete(ligne[debut:fin], i - debut))
+            if len(pertinentes) == 0:
+                continue
+            pertinents_existent[i] = True
+
+            top_k = selection_top_k(ligne, min(K, n - 1))
+            trouves = np.count_nonzero((top_k >= debut) & (top_k < fin))
+            # Sur les petits stores, moins de K images peuvent être renvoyées
+            precisions[i] = trouves / len(top_k)
+            rappels[i] = trouves / len(pertinentes)
+
+            # Rang pessimiste (égalités comptées avant) de chaque image pertinente
+            rangs = np.searchsorted(np.sort(ligne), pertinentes, side='right')
+            average_precisions[i] = np.mean(np.arange(1, len(pertinentes) + 1) / rangs)
+    duree = time.perf_counter() - debut_chrono
+
+    rappel_par_classe = {
+        classe: float(rappels[d:f][pertinents_existent[d:f]].mean()) if pertinents_existent[d:f].any() else 0.0
+        for classe, (d, f) in partitions.items()
+    }
+    return {
+        'precision_at_k': float(precisions[pertinents_existent].mean()) if pertinents_existent.any() else 0.0,
+        'map': float(average_precisions[pertinents_existent].mean()) if pertinents_existent.any() else 0.0,
+        'rappel_par_classe': rappel_par_classe,
+        'images': n,
+        'duree_s': duree,
+        'ms_par_requete': 1000 * duree / n if n else 0.0
+    }
+
+
+def evaluer_cascade(store, fichier, distance_type, K, M, grossier, nb_requetes, graine=0):
+    """Rappel moyen de la cascade par rapport à la recherche exhaustive, et temps par requête"""
+    store_glcm = None
+    if grossier == 'glcm':
+        store_glcm = charger_signatures(os.path.join(os.path.dirname(fichier), "SignaturesGlcm.npy"), verifier=False)
+
+    matrice = store['caracteristiques']
+    requetes = np.random.default_rng(graine).choice(len(matrice), min(nb_requetes, len(matrice)), replace=False)
+    rappels = []
+    duree_exhaustive = 0.0
+    duree_cascade = 0.0
+    for i in requetes:
+        debut = time.perf_counter()
+        exhaustifs, _ = recherche_par_classes(store, matrice[i], distance_type, K)
+        duree_exhaustive += time.perf_counter() - debut
+
+        debut = time.perf_counter()
+        if store_glcm is not None:
+            representation = representation_glcm(store, store_glcm, store_glcm['caracteristiques'][i], distance_type)
+        else:
+            representation = representation_pca(fichier, matrice[i], distance_type)
+        resultats, _ = recherche_cascade(store, matrice[i], distance_type, K, M, representation)
+        duree_cascade += time.perf_counter() - debut
+
+        rappels.append(rappel_cascade(resultats, exhaustifs))
+
+    return {
+        'rappel_cascade': float(np.mean(rappels)),
+        'ms_exhaustive': 1000 * duree_exhaustive / len(requetes),
+        'ms_cascade': 1000 * duree_cascade / len(requetes)
+    }
+
+
+def stores_disponibles(dossier=SIGNATURES_PATH):
+    """Fichiers de signatures présents, indexés par nom de descripteur"""
+    fichiers = sorted(glob.glob(os.path.join(dossier, "Signatures*.npy")))
+    return {os.path.basename(f)[len("Signatures"):-len(".npy")]: f for f in fichiers}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Évaluation leave-one-out des descripteurs CBIR")
+    parser.add_argument("--k", type=int, default=10, help="Nombre de résultats évalués (precision@K)")
+    parser.add_argument("--bloc", type=int, default=128, help="Nombre de requêtes par bloc de distances")
+    parser.add_argument("--descripteurs", nargs="*", help="Descripteurs à évaluer (Glcm, Haralick, Bit, Concat)")
+    parser.add_argument("--distances", nargs="*", default=list(METRIQUES_SCIPY), help="Distances à évaluer")
+    parser.add_argument("--json", help="Chemin du rapport JSON à écrire")
+    parser.add_argument("--tailles", nargs="*", type=int,
+                        help="Tailles canoniques à comparer (réextraction depuis le dataset)")
+    parser.add_argument("--dataset", default=DATASET_PATH, help="Dataset utilisé avec --tailles")
+    parser.add_argument("--cascade", type=int, help="Nombre de candidats M de la recherche en cascade")
+    parser.add_argument("--grossier", default="pca", choices=["pca", "glcm"], help="Passe grossière de la cascade")
+    parser.add_argument("--requetes", type=int, default=500, help="Requêtes tirées pour évaluer la cascade")
+    args = parser.parse_args(argv)
+
+    stores = stores_disponibles()
+    if args.tailles:
+        stores = {nom: None for nom in (args.descripteurs or ["Glcm", "Haralick", "Bit", "Concat"])}
+    elif args.descripteurs:
+        stores = {nom: f for nom, f in stores.items() if nom in args.descripteurs}
+    if not stores:
+        print("Aucun fichier de signatures trouvé.", file=sys.stderr)
+        return 1
+
+    configurations = []
+    for nom, fichier in stores.items():
+        if not args.tailles:
+            # Les requêtes viennent du store lui-même : les conditions d'extraction n'ont pas à correspondre
+            configurations.append(
+                (nom, None, lambda fichier=fichier: (charger_signatures(fichier, verifier=False), None))
+            )
+            continue
+        for taille in args.tailles:
+            def extraire(nom=nom, taille=taille):
+                debut = time.perf_counter()
+                brut, n = calculer_signatures(args.dataset, nom.lower(), taille_canonique=taille)
+                return construire_store(brut), 1000 * (time.perf_counter() - debut) / max(n, 1)
+            configurations.append((nom, taille, extraire))
+
+    rapport = []
+    print(f"{'Descripteur':<12} {'Taille':>6} {'Distance':<10} {'P@' + str(args.k):>7} {'mAP':>7} "
+          f"{'Durée (s)':>10} {'ms/req':>8} {'ms/img':>8}")
+    for nom, taille, extraire in configurations:
+        store, ms_par_image = extraire()
+        for distance_type in args.distances:
+            resultat = evaluer_store(store, distance_type, args.k, args.bloc)
+            resultat.update({
+                'descripteur': nom, 'distance': distance_type, 'k': args.k,
+                'taille_canonique': taille, 'ms_extraction_par_image': ms_par_image
+            })
+            rapport.append(resultat)
+            print(f"{nom:<12} {'-' if taille is None else taille:>6} {distance_type:<10} "
+                  f"{resultat['precision_at_k']:>7.4f} {resultat['map']:>7.4f} "
+                  f"{resultat['duree_s']:>10.2f} {resultat['ms_par_requete']:>8.3f} "
+                  f"{'-' if ms_par_image is None else f'{ms_par_image:.2f}':>8}")
+
+            if args.cascade and taille is None:
+                cascade = evaluer_cascade(
+                    store, stores[nom], distance_type, args.k, args.cascade, args.grossier, args.requetes
+                )
+                resultat.update(cascade)
+                print(f"{'':<12} {'':>6} {'cascade':<10} rappel={cascade['rappel_cascade']:.4f} "
+                      f"exhaustive={cascade['ms_exhaustive']:.3f} ms cascade={cascade['ms_cascade']:.3f} ms "
+                      f"(M={args.cascade}, {args.grossier})")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rapport, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
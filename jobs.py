@@ -0,0 +1,69 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+NB_WORKERS = int(os.environ.get("CBIR_EXTRACTION_WORKERS", "2"))
+STATUTS_ACTIFS = ('en_attente', 'en_cours')
+
+logger = logging.getLogger("cbir.jobs")
+
+# Partagés par toutes les sessions Streamlit du processus
+_executeur = ThreadPoolExecutor(max_workers=NB_WORKERS, thread_name_prefix="cbir-travail")
+_verrou = threading.Lock()
+_travaux = {}
+
+
+def _mettre_a_jour(travail, **valeurs):
+    with _verrou:
+        travail.update(valeurs)
+
+
+def _executer(travail, fonction, args):
+    _mettre_a_jour(travail, statut='en_cours', debut=time.time())
+
+    def progression(valeur):
+        _mettre_a_jour(travail, progression=float(min(max(valeur, 0.0), 1.0)))
+
+    try:
+        resultat = fonction(*args, progression=progression)
+    except Exception as e:
+        logger.exception("Échec du travail %s", travail['cle'])
+        _mettre_a_jour(travail, statut='erreur', erreur=str(e), fin=time.time())
+    else:
+        _mettre_a_jour(travail, statut='termine', progression=1.0, resultat=resultat, fin=time.time())
+
+
+def soumettre_travail(cle, fonction, *args):
+    """Met un travail en file, ou renvoie l'identifiant du travail identique déjà en cours
+
+    `fonction` est appelée avec `args` et un argument nommé `progression` (valeur entre 0 et 1).
+    """
+    with _verrou:
+        travail = _travaux.get(cle)
+        if travail is not None and travail['statut'] in STATUTS_ACTIFS:
+            return travail['id']
+
+        travail = {
+            'id': uuid.uuid4().hex,
+            'cle': cle,
+            'statut': 'en_attente',
+            'progression': 0.0,
+            'resultat': None,
+            'erreur': None,
+            'soumis': time.time(),
+            'debut': None,
+            'fin': None
+        }
+        _travaux[cle] = travail
+
+    _executeur.submit(_executer, travail, fonction, args)
+    return travail['id']
+
+
+def etat_travaux():
+    """Copie de l'état du dernier travail soumis pour chaque clé"""
+    with _verrou:
+        return {cle: dict(travail) for cle, travail in _travaux.items()}
@@ -0,0 +1,220 @@
+"""Précalcul hors ligne des K plus proches voisins de chaque image indexée
+
+Un graphe par couple descripteur × distance est écrit à côté des signatures
+(`VoisinsConcat_euclidean.npz`, ...) : identifiants int32, distances float32 et
+une empreinte 64 bits par ligne ; chemins et classes sont lus dans le fichier de
+signatures dont le graphe est issu. Relancer la commande ne recalcule que les
+lignes touchées par les images ajoutées, modifiées ou supprimées depuis la
+génération précédente.
+
+    python knn_graph.py --k 20
+"""
+import os
+import sys
+import hashlib
+import argparse
+
+import numpy as np
+
+from cbir_functions import (
+    DATASET_PATH, SIGNATURES_PATH, DESCRIPTEURS, METRIQUES_SCIPY,
+    charger_signatures, calculer_distances, chemin_graphe, empreinte_image
+)
+from evaluation import blocs_distances
+from thumbnails import EXTENSIONS_IMAGES
+
+
+def empreintes_lignes(store):
+    """Empreinte 64 bits (chemin et caractéristiques) de chaque ligne d'un store"""
+    return np.array([
+        int.from_bytes(hashlib.blake2b(chemin.encode("utf-8") + ligne.tobytes(), digest_size=8).digest(), "little")
+        for chemin, ligne in zip(store['chemins'], store['caracteristiques'])
+    ], dtype=np.uint64)
+
+
+def _top_k_lignes(distances, K):
+    """Indices et distances des K plus petites valeurs de chaque ligne, triés"""
+    K = min(K, distances.shape[1])
+    candidats = np.argpartition(distances, K - 1, axis=1)[:, :K]
+    valeurs = np.take_along_axis(distances, candidats, axis=1)
+    ordre = np.argsort(valeurs, axis=1, kind='stable')
+    return np.take_along_axis(candidats, ordre, axis=1), np.take_along_axis(valeurs, ordre, axis=1)
+
+
+def _voisins_complets(matrice, lignes, distance_type, K, taille_bloc):
+    """Recalcule entièrement les voisins des lignes données (la ligne elle-même exclue)"""
+    voisins = np.empty((len(lignes), K), dtype=np.int32)
+    distances = np.empty((len(lignes), K), dtype=np.float32)
+    for debut in range(0, len(lignes), taille_bloc):
+        bloc = lignes[debut:debut + taille_bloc]
+        d = calculer_distances(matrice[bloc], matrice, distance_type)
+        d[np.arange(len(bloc)), bloc] = np.inf
+        ids, valeurs = _top_k_lignes(d, K)
+        voisins[debut:debut + len(bloc)] = ids
+        distances[debut:debut + len(bloc)] = valeurs
+    return voisins, distances
+
+
+def construire_graphe(store, distance_type, K, taille_bloc=256):
+    """Construit le graphe complet des K plus proches voisins d'un store"""
+    matrice = store['caracteristiques']
+    K = min(K, len(matrice) - 1)
+    voisins = np.empty((len(matrice), K), dtype=np.int32)
+    distances = np.empty((len(matrice), K), dtype=np.float32)
+    for debut, d in blocs_distances(matrice, distance_type, taille_bloc):
+        fin = debut + len(d)
+        d[np.arange(len(d)), np.arange(debut, fin)] = np.inf
+        ids, valeurs = _top_k_lignes(d, K)
+        voisins[debut:fin] = ids
+        distances[debut:fin] = valeurs
+    return voisins, distances
+
+
+def mettre_a_jour_graphe(ancien, store, distance_type, K, taille_bloc=256, empreintes=None):
+    """Met à jour un graphe existant après ajout, modification ou suppression d'images"""
+    matrice = store['caracteristiques']
+    n = len(matrice)
+    K = min(K, n - 1)
+    if empreintes is None:
+        empreintes = empreintes_lignes(store)
+
+    # Associer chaque ancienne ligne à sa nouvelle position si l'image (chemin et signature) est inchangée
+    position = {int(e): i for i, e in enumerate(empreintes)}
+    ancien_vers_nouveau = np.array([position.get(int(e), -1) for e in ancien['empreintes']], dtype=np.int64)
+
+    modifiees = np.ones(n, dtype=bool)
+    modifiees[ancien_vers_nouveau[ancien_vers_nouveau >= 0]] = False
+    nouvelles = np.flatnonzero(modifiees)
+
+    voisins = np.empty((n, K), dtype=np.int32)
+    distances = np.empty((n, K), dtype=np.float32)
+
+    # Une ligne dont un voisin a disparu ou changé doit être recalculée entièrement
+    conservees = np.flatnonzero(ancien_vers_nouveau >= 0)
+    anciens_voisins = ancien_vers_nouveau[ancien['voisins'][conservees, :K]]
+    invalides = (anciens_voisins < 0).any(axis=1)
+
+    a_recalculer = np.concatenate([nouvelles, ancien_vers_nouveau[conservees[invalides]]])
+    if len(a_recalculer):
+        ids, valeurs = _voisins_complets(matrice, a_recalculer, distance_type, K, taille_bloc)
+        voisins[a_recalculer] = ids
+        distances[a_recalculer] = valeurs
+
+    # Les autres lignes fusionnent leurs voisins actuels avec les images nouvelles ou modifiées
+    a_fusionner = conservees[~invalides]
+    lignes = ancien_vers_nouveau[a_fusionner]
+    for debut in range(0, len(lignes), taille_bloc):
+        bloc = lignes[debut:debut + taille_bloc]
+        ids = anciens_voisins[~invalides][debut:debut + taille_bloc]
+        valeurs = ancien['distances'][a_fusionner[debut:debut + taille_bloc], :K].astype(np.float64)
+        if len(nouvelles):
+            d = calculer_distances(matrice[bloc], matrice[nouvelles], distance_type)
+            ids = np.concatenate([ids, np.broadcast_to(nouvelles, d.shape)], axis=1)
+            valeurs = np.concatenate([valeurs, d], axis=1)
+        meilleurs, valeurs = _top_k_lignes(valeurs, K)
+        voisins[bloc] = np.take_along_axis(ids, meilleurs, axis=1)
+        distances[bloc] = valeurs
+
+    return voisins, distances
+
+
+def _enregistrer_npz(fichier, **tableaux):
+    # Écriture atomique : les lecteurs voient l'ancien ou le nouveau fichier, jamais un fichier partiel
+    temporaire = f"{fichier}.{os.getpid()}.tmp.npz"
+    np.savez(temporaire, **tableaux)
+    os.replace(temporaire, fichier)
+
+
+def generer_graphe(descripteur, distance_type, K, taille_bloc=256, complet=False):
+    """Génère ou met à jour le graphe d'un descripteur et d'une distance"""
+    signatures_file = os.path.join(SIGNATURES_PATH, f"Signatures{descripteur}.npy")
+    store = charger_signatures(signatures_file)
+    fichier = chemin_graphe(descripteur, distance_type)
+
+    empreintes = empreintes_lignes(store)
+
+    ancien = None
+    if not complet and os.path.exists(fichier):
+        with np.load(fichier) as donnees:
+            ancien = {cle: donnees[cle] for cle in donnees.files}
+        # Graphe d'un format antérieur (sans empreintes) ou avec moins de voisins : reconstruction
+        if 'empreintes' not in ancien or ancien['voisins'].shape[1] < min(K, len(store['chemins']) - 1):
+            ancien = None
+
+    if ancien is None:
+        voisins, distances = construire_graphe(store, distance_type, K, taille_bloc)
+    else:
+        voisins, distances = mettre_a_jour_graphe(ancien, store, distance_type, K, taille_bloc, empreintes)
+
+    _enregistrer_npz(
+        fichier,
+        voisins=voisins,
+        distances=distances,
+        empreintes=empreintes,
+        source_mtime_ns=np.int64(os.stat(signatures_file).st_mtime_ns)
+    )
+    return fichier
+
+
+def indexer_empreintes(chemin_dossier=DATASET_PATH):
+    """Met à jour l'index des empreintes de contenu des images du dataset"""
+    fichier = os.path.join(SIGNATURES_PATH, "Empreintes.npz")
+    connues = {}
+    if os.path.exists(fichier):
+        with np.load(fichier) as donnees:
+            connues = {c: (int(m), e) for c, m, e in zip(donnees['chemins'], donnees['mtimes'], donnees['empreintes'])}
+
+    chemins, mtimes, empreintes = [], [], []
+    for root, dirs, files in os.walk(chemin_dossier):
+        for file in files:
+            if file.lower().endswith(EXTENSIONS_IMAGES):
+                path = os.path.join(root, file)
+                relative_path = os.path.relpath(path, chemin_dossier)
+                mtime_ns = os.stat(path).st_mtime_ns
+
+                # Ne relire que les fichiers modifiés depuis la dernière indexation
+                if connues.get(relative_path, (None,))[0] == mtime_ns:
+                    empreinte = connues[relative_path][1]
+                else:
+                    with open(path, "rb") as f:
+                        empreinte = empreinte_image(f.read())
+
+                chemins.append(relative_path)
+                mtimes.append(mtime_ns)
+                empreintes.append(empreinte)
+
+    ordre = np.argsort(np.array(empreintes, dtype=str), kind='stable')
+    _enregistrer_npz(
+        fichier,
+        empreintes=np.array(empreintes, dtype=str)[ordre],
+        chemins=np.array(chemins, dtype=str)[ordre],
+        mtimes=np.array(mtimes, dtype=np.int64)[ordre]
+    )
+    return fichier
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Précalcul des K plus proches voisins des images indexées")
+    parser.add_argument("--k", type=int, default=20, help="Nombre de voisins conservés par image")
+    parser.add_argument("--bloc", type=int, default=256, help="Nombre de lignes par bloc de distances")
+    parser.add_argument("--descripteurs", nargs="*", default=list(DESCRIPTEURS.values()))
+    parser.add_argument("--distances", nargs="*", default=list(METRIQUES_SCIPY))
+    parser.add_argument("--complet", action="store_true", help="Reconstruire les graphes au lieu de les mettre à jour")
+    args = parser.parse_args(argv)
+
+    indexer_empreintes()
+    for descripteur in args.descripteurs:
+        if not os.path.exists(os.path.join(SIGNATURES_PATH, f"Signatures{descripteur}.npy")):
+            print(f"Signatures {descripteur} absentes, graphe ignoré.", file=sys.stderr)
+            continue
+        for distance_type in args.distances:
+            try:
+                print(generer_graphe(descripteur, distance_type, args.k, args.bloc, args.complet))
+            except ValueError as e:
+                print(f"{e}, graphe ignoré.", file=sys.stderr)
+                break
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
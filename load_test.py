@@ -0,0 +1,395 @@
+"""Test de charge de bout en bout des chemins d'authentification et de recherche
+
+Des clients simulés (un thread chacun, comme les sessions Streamlit d'un même
+processus) enchaînent inscriptions, connexions faciales, connexions OAuth et
+recherches CBIR. MongoDB est remplacé par une base en mémoire et Google par un
+fournisseur OAuth local ; images et encodages faciaux sont synthétiques.
+
+    python load_test.py --concurrence 1 4 16 64 --duree 20 --rapport charge.json
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+import auth_functions
+from auth_functions import (
+    FACE_MATCH_THRESHOLD, set_database, get_user_by_username, insert_user, add_face_encoding,
+    identify_face, verify_face, hash_password, fetch_google_user_info, find_or_create_oauth_user
+)
+from cbir_functions import (
+    SIGNATURES_PATH, DIMENSIONS, charger_signatures, construire_store, concat_parallele, recherche_par_classes
+)
+from session_store import create_session_store, create_session, create_oauth_state, consume_oauth_state
+
+SCENARIOS = {
+    'inscription': 1,
+    'connexion_visage': 2,
+    'verification_visage': 2,
+    'oauth_google': 1,
+    'recherche': 4
+}
+
+
+class FakeCollection:
+    """Collection MongoDB en mémoire limitée aux requêtes utilisées par l'application
+
+    Un document n'est jamais modifié en place : une mise à jour le remplace par une copie. Le verrou
+    ne protège que les références, les copies renvoyées aux appelants sont faites en dehors.
+    """
+
+    def __init__(self, latence):
+        self._documents = {}
+        self._par_username = {}
+        self._compteur = 0
+        self._verrou = threading.Lock()
+        self._latence = latence
+
+    @staticmethod
+    def _valeur(document, chemin):
+        for cle in chemin.split("."):
+            if not isinstance(document, dict) or cle not in document:
+                return None
+            document = document[cle]
+        return document
+
+    def _correspond(self, document, filtre):
+        return all(self._valeur(document, cle) == valeur for cle, valeur in filtre.items())
+
+    def _candidats(self, filtre):
+        # À appeler sous le verrou ; index par nom d'utilisateur comme l'index MongoDB de l'application
+        if "username" in filtre:
+            identifiant = self._par_username.get(filtre["username"])
+            return [] if identifiant is None else [self._documents[identifiant]]
+        return list(self._documents.values())
+
+    @staticmethod
+    def _projeter(document, projection):
+        document = copy.deepcopy(document)
+        if projection:
+            document = {k: v for k, v in document.items() if k in projection or k == '_id'}
+        return document
+
+    @staticmethod
+    def _appliquer(document, operations):
+        """Nouveau document après mise à jour ; seuls les niveaux modifiés sont copiés"""
+        document = dict(document)
+        for chemin, valeur in operations.get("$set", {}).items():
+            cible = document
+            *parents, cle = chemin.split(".")
+            for parent in parents:
+                cible[parent] = dict(cible.get(parent) or {})
+                cible = cible[parent]
+            cible[cle] = valeur
+        for cle in operations.get("$unset", {}):
+            document.pop(cle, None)
+        for cle, ajout in operations.get("$push", {}).items():
+            liste = list(document.get(cle, []))
+            position = ajout.get("$position", len(liste))
+            liste[position:position] = ajout["$each"]
+            if "$slice" in ajout:
+                liste = liste[ajout["$slice"]:] if ajout["$slice"] < 0 else liste[:ajout["$slice"]]
+            document[cle] = liste
+        return document
+
+    def _attendre(self):
+        # Aller-retour réseau simulé vers le serveur MongoDB
+        if self._latence:
+            time.sleep(self._latence)
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def find_one(self, filtre, projection=None):
+        self._attendre()
+        with self._verrou:
+            candidats = self._candidats(filtre)
+        for document in candidats:
+            if self._correspond(document, filtre):
+                return self._projeter(document, projection)
+        return None
+
+    def find(self, filtre):
+        self._attendre()
+        with self._verrou:
+            candidats = self._candidats(filtre)
+        return [self._projeter(d, None) for d in candidats if self._correspond(d, filtre)]
+
+    def insert_one(self, document):
+        self._attendre()
+        document = copy.deepcopy(document)
+        with self._verrou:
+            self._compteur += 1
+            document.setdefault('_id', self._compteur)
+            self._documents[document['_id']] = document
+            if 'username' in document:
+                self._par_username[document['username']] = document['_id']
+
+    def update_one(self, filtre, operations):
+        self._attendre()
+        with self._verrou:
+            for document in self._candidats(filtre):
+                if self._correspond(document, filtre):
+                    document = self._documents[document['_id']] = self._appliquer(document, operations)
+                    if 'username' in document:
+                        self._par_username[document['username']] = document['_id']
+                    return
+
+    def instantane(self):
+        """État courant de la collection (peu coûteux : les documents ne sont jamais modifiés)"""
+        with self._verrou:
+            return dict(self._documents), dict(self._par_username), self._compteur
+
+    def restaurer(self, instantane):
+        documents, par_username, compteur = instantane
+        with self._verrou:
+            self._documents = dict(documents)
+            self._par_username = dict(par_username)
+            self._compteur = compteur
+
+
+class FakeDatabase:
+    """Base MongoDB en mémoire"""
+
+    def __init__(self, latence=0.0):
+        self._collections = defaultdict(lambda: FakeCollection(latence))
+
+    def __getitem__(self, nom):
+        return self._collections[nom]
+
+    def instantane(self):
+        return {nom: collection.instantane() for nom, collection in self._collections.items()}
+
+    def restaurer(self, instantane):
+        """Revient à un état antérieur ; les collections créées depuis sont vidées"""
+        for nom, collection in list(self._collections.items()):
+            collection.restaurer(instantane.get(nom, ({}, {}, 0)))
+
+
+class _FournisseurOAuth(BaseHTTPRequestHandler):
+    # Faux Google : le code d'autorisation devient le jeton puis l'identifiant de l'utilisateur
+
+    def _repondre(self, donnees):
+        corps = json.dumps(donnees).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def do_POST(self):
+        longueur = int(self.headers.get("Content-Length", 0))
+        code = parse_qs(self.rfile.read(longueur).decode("utf-8")).get("code", [""])[0]
+        self._repondre({"access_token": f"jeton-{code}"})
+
+    def do_GET(self):
+        jeton = self.headers.get("Authorization", "").replace("Bearer jeton-", "")
+        if urlparse(self.path).path != "/userinfo" or not jeton:
+            self._repondre({"error": "invalid_token"})
+            return
+        self._repondre({"id": jeton, "name": f"Utilisateur {jeton}", "email": f"{jeton}@exemple.test"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def demarrer_fournisseur_oauth():
+    """Démarre le faux fournisseur OAuth et y redirige les appels Google"""
+    serveur = ThreadingHTTPServer(("127.0.0.1", 0), _FournisseurOAuth)
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{serveur.server_address[1]}"
+    auth_functions.GOOGLE_TOKEN_URL = f"{base}/token"
+    auth_functions.GOOGLE_USERINFO_URL = f"{base}/userinfo"
+    return serveur
+
+
+def image_synthetique(rng, taille=256):
+    """Texture aléatoire lissée, en niveaux de gris"""
+    bruit = rng.integers(0, 256, (taille, taille), dtype=np.uint8)
+    return cv2.GaussianBlur(bruit, (0, 0), sigmaX=float(rng.uniform(0.5, 4.0)))
+
+
+def encodage_synthetique(rng):
+    vecteur = rng.normal(size=128)
+    return vecteur / np.linalg.norm(vecteur)
+
+
+class Simulation:
+    """Données partagées par les clients simulés"""
+
+    def __init__(self, nb_utilisateurs, taille_index, session_backend, seed=0):
+        rng = np.random.default_rng(seed)
+        self.sessions = create_session_store(session_backend)
+        # Le callback OAuth passe par une autre instance du stockage, comme sur une autre réplique
+        self.sessions_callback = self.sessions if session_backend == "memory" else create_session_store(session_backend)
+        self.compteur = 0
+        self.verrou = threading.Lock()
+
+        # Comptes existants, chacun avec un encodage facial
+        self.visages = {}
+        for i in range(nb_utilisateurs):
+            username = f"charge_{i}"
+            insert_user({
+                'username': username, 'email': f"{username}@exemple.test",
+                'password_hash': hash_password(username), 'auth_methods': {'local': True},
+                'has_face_encoding': False
+            })
+            self.visages[username] = encodage_synthetique(rng)
+            add_face_encoding(username, self.visages[username])
+        self.utilisateurs = list(self.visages)
+
+        # Store réel s'il existe et est à jour, sinon un store synthétique de la même dimension
+        try:
+            self.store = charger_signatures(os.path.join(SIGNATURES_PATH, "SignaturesConcat.npy"))
+        except (OSError, ValueError):
+            caracteristiques = rng.normal(size=(taille_index, DIMENSIONS["Concat"])).astype(str)
+            classes = np.array([f"classe_{i % 20}" for i in range(taille_index)])
+            chemins = np.array([f"{c}/{i}.jpg" for i, c in enumerate(classes)])
+            self.store = construire_store(np.column_stack([caracteristiques, classes, chemins]))
+
+        self.images = [image_synthetique(rng) for _ in range(16)]
+
+    def nouvel_identifiant(self):
+        with self.verrou:
+            self.compteur += 1
+            return self.compteur
+
+    def executer(self, scenario, rng):
+        """Exécute un scénario ; renvoie False si le résultat est incorrect"""
+        if scenario == 'inscription':
+            username = f"inscrit_{self.nouvel_identifiant()}"
+            if get_user_by_username(username):
+                return False
+            insert_user({
+                'username': username, 'email': f"{username}@exemple.test",
+                'password_hash': hash_password(username), 'auth_methods': {'local': True},
+                'has_face_encoding': False
+            })
+            add_face_encoding(username, encodage_synthetique(rng))
+            return True
+
+        if scenario in ('connexion_visage', 'verification_visage'):
+            username = self.utilisateurs[rng.integers(0, len(self.utilisateurs))]
+            capture = self.visages[username] + rng.normal(scale=0.02, size=128)
+            if scenario == 'connexion_visage':
+                user, distance = identify_face(capture)
+            else:
+                user, distance = verify_face(username, capture)
+            if user is None or user['username'] != username or distance >= FACE_MATCH_THRESHOLD:
+                return False
+            create_session(self.sessions, username, 'face')
+            return True
+
+        if scenario == 'oauth_google':
+            nonce = f"nonce-{self.nouvel_identifiant()}"
+            state = create_oauth_state(self.sessions, 'google', 'login', nonce)
+            contexte = consume_oauth_state(self.sessions_callback, state, nonce)
+            if contexte is None or contexte['provider'] != 'google':
+                return False
+            code = f"g{rng.integers(0, 1000)}"
+            username = find_or_create_oauth_user('google', fetch_google_user_info(code))
+            create_session(self.sessions, username, 'google')
+            return True
+
+        image = self.images[rng.integers(0, len(self.images))]
+        resultats, _ = recherche_par_classes(self.store, concat_parallele(image), 'euclidean', 10)
+        return len(resultats) > 0
+
+
+def executer_palier(simulation, concurrence, duree, poids):
+    """Fait tourner `concurrence` clients pendant `duree` secondes"""
+    mesures = []
+    verrou = threading.Lock()
+    fin = time.perf_counter() + duree
+    scenarios = list(poids)
+    probabilites = np.array([poids[s] for s in scenarios], dtype=float)
+    probabilites /= probabilites.sum()
+
+    def client(graine):
+        rng = np.random.default_rng(graine)
+        locales = []
+        while time.perf_counter() < fin:
+            scenario = scenarios[rng.choice(len(scenarios), p=probabilites)]
+            debut = time.perf_counter()
+            try:
+                ok = simulation.executer(scenario, rng)
+            except Exception:
+                ok = False
+            locales.append((scenario, time.perf_counter() - debut, ok))
+        with verrou:
+            mesures.extend(locales)
+
+    debut = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrence) as executeur:
+        for graine in range(concurrence):
+            executeur.submit(client, random.randrange(2 ** 32) + graine)
+    ecoule = time.perf_counter() - debut
+
+    resultats = {}
+    for scenario in scenarios + ['total']:
+        selection = [m for m in mesures if scenario == 'total' or m[0] == scenario]
+        if not selection:
+            continue
+        latences = np.array([m[1] for m in selection]) * 1000
+        erreurs = sum(1 for m in selection if not m[2])
+        p50, p95, p99 = np.percentile(latences, [50, 95, 99])
+        resultats[scenario] = {
+            'requetes': len(selection),
+            'debit_par_s': len(selection) / ecoule,
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'taux_erreur': erreurs / len(selection)
+        }
+    return resultats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test de charge des chemins d'authentification et de recherche")
+    parser.add_argument("--concurrence", nargs="*", type=int, default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--duree", type=float, default=15.0, help="Durée de chaque palier (secondes)")
+    parser.add_argument("--utilisateurs", type=int, default=1000, help="Comptes avec visage créés au départ")
+    parser.add_argument("--taille-index", type=int, default=10000, help="Images du store synthétique")
+    parser.add_argument("--latence-mongo", type=float, default=1.0, help="Latence simulée par appel MongoDB (ms)")
+    parser.add_argument("--sessions", default="memory", choices=["memory", "sqlite"])
+    parser.add_argument("--scenarios", nargs="*", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--rapport", default="load_report.json", help="Rapport JSON")
+    args = parser.parse_args(argv)
+
+    base = FakeDatabase(args.latence_mongo / 1000)
+    set_database(base)
+    demarrer_fournisseur_oauth()
+    simulation = Simulation(args.utilisateurs, args.taille_index, args.sessions)
+    poids = {s: SCENARIOS[s] for s in args.scenarios}
+    # Chaque palier repart des mêmes comptes : les inscriptions d'un palier ne grossissent pas
+    # la base de la correspondance 1:N des suivants
+    etat_initial = base.instantane()
+
+    rapport = {'parametres': vars(args), 'paliers': []}
+    print(f"{'Clients':>7} {'Scénario':<20} {'Req.':>7} {'Req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'Erreurs':>8}")
+    for concurrence in args.concurrence:
+        base.restaurer(etat_initial)
+        resultats = executer_palier(simulation, concurrence, args.duree, poids)
+        rapport['paliers'].append({'concurrence': concurrence, 'resultats': resultats})
+        for scenario, r in resultats.items():
+            print(f"{concurrence:>7} {scenario:<20} {r['requetes']:>7} {r['debit_par_s']:>8.1f} {r['p50_ms']:>8.1f} "
+                  f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['taux_erreur']:>8.2%}")
+
+    with open(args.rapport, "w", encoding="utf-8") as f:
+        json.dump(rapport, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
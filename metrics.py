@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("CBIR_METRICS_PORT", "9108"))
+LOGS_STRUCTURES = os.environ.get("CBIR_METRICS_LOG", "0") == "1"
+
+# Bornes des histogrammes (secondes), de la milliseconde à la dizaine de secondes
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("cbir.metrics")
+if LOGS_STRUCTURES:
+    # Une ligne JSON par observation sur stderr, indépendamment du niveau racine
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_verrou = threading.Lock()
+_histogrammes = {}
+_erreurs = {}
+
+
+def observer(etape, duree, erreur=False):
+    """Enregistre la durée (en secondes) d'une étape dans son histogramme"""
+    indice = bisect.bisect_left(BUCKETS, duree)
+    with _verrou:
+        histo = _histogrammes.get(etape)
+        if histo is None:
+            # [compteurs par borne + infini, somme, nombre]
+            histo = _histogrammes[etape] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        histo[0][indice] += 1
+        histo[1] += duree
+        histo[2] += 1
+        if erreur:
+            _erreurs[etape] = _erreurs.get(etape, 0) + 1
+
+    if LOGS_STRUCTURES:
+        logger.info(json.dumps({"etape": etape, "duree_ms": round(duree * 1000, 3), "erreur": erreur}))
+
+
+@contextmanager
+def chronometre(etape):
+    """Mesure la durée du bloc encadré"""
+    debut = time.perf_counter()
+    erreur = False
+    try:
+        yield
+    except BaseException:
+        erreur = True
+        raise
+    finally:
+        observer(etape, time.perf_counter() - debut, erreur)
+
+
+def chronometre_fonction(etape):
+    """Décorateur mesurant la durée de chaque appel d'une fonction"""
+    def decorateur(fonction):
+        @wraps(fonction)
+        def enveloppe(*args, **kwargs):
+            with chronometre(etape):
+                return fonction(*args, **kwargs)
+        return enveloppe
+    return decorateur
+
+
+def exposition_prometheus():
+    """Sérialise les métriques au format texte Prometheus"""
+    with _verrou:
+        instantane = {etape: (list(h[0]), h[1], h[2]) for etape, h in _histogrammes.items()}
+        erreurs = dict(_erreurs)
+
+    lignes = [
+        "# HELP cbir_stage_duration_seconds Durée des étapes de recherche et d'authentification.",
+        "# TYPE cbir_stage_duration_seconds histogram",
+    ]
+    for etape in sorted(instantane):
+        compteurs, somme, nombre = instantane[etape]
+        cumul = 0
+        for borne, compte in zip(BUCKETS, compteurs):
+            cumul += compte
+            lignes.append(f'cbir_stage_duration_seconds_bucket{{stage="{etape}",le="{borne}"}} {cumul}')
+        lignes.append(f'cbir_stage_duration_seconds_bucket{{stage="{etape}",le="+Inf"}} {nombre}')
+        lignes.append(f'cbir_stage_duration_seconds_sum{{stage="{etape}"}} {somme:.6f}')
+        lignes.append(f'cbir_stage_duration_seconds_count{{stage="{etape}"}} {nombre}')
+
+    lignes.append("# HELP cbir_stage_errors_total Nombre d'étapes terminées par une exception.")
+    lignes.append("# TYPE cbir_stage_errors_total counter")
+    for etape in sorted(erreurs):
+        lignes.append(f'cbir_stage_errors_total{{stage="{etape}"}} {erreurs[etape]}')
+
+    return "\n".join(lignes) + "\n"
+
+
+def reinitialiser():
+    """Vide toutes les métriques collectées"""
+    with _verrou:
+        _histogrammes.clear()
+        _erreurs.clear()
+
+
+class _GestionnaireMetriques(BaseHTTPRequestHandler):
+    routes = {
+        "/metrics": lambda: (200, "text/plain; version=0.0.4; charset=utf-8", exposition_prometheus()),
+    }
+
+    def do_GET(self):
+        route = self.routes.get(self.path.split("?", 1)[0])
+        if route is None:
+            self.send_error(404)
+            return
+
+        statut, type_contenu, corps = route()
+        corps = corps.encode("utf-8")
+        self.send_response(statut)
+        self.send_header("Content-Type", type_contenu)
+        self.send_header("Content-Length", str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def enregistrer_route(chemin, fonction):
+    """Ajoute une route GET au serveur ; `fonction` renvoie (statut, type de contenu, corps)"""
+    _GestionnaireMetriques.routes[chemin] = fonction
+
+
+def demarrer_serveur_metriques(port=METRICS_PORT):
+    """Démarre le serveur HTTP d'exposition des métriques dans un thread dédié"""
+    try:
+        serveur = ThreadingHTTPServer(("0.0.0.0", port), _GestionnaireMetriques)
+    except OSError as e:
+        logger.warning("Serveur de métriques non démarré sur le port %s: %s", port, e)
+        return None
+
+    thread = threading.Thread(target=serveur.serve_forever, name="cbir-metrics", daemon=True)
+    thread.start()
+    return serveur
@@ -0,0 +1,23 @@
+"""Lanceur de l'application : services de fond puis serveur Streamlit dans le même processus
+
+Le préchauffage, /healthz et /readyz démarrent avant que le serveur n'accepte des connexions ;
+les arguments sont transmis à `streamlit run app.py`.
+
+    python serve.py --server.port 8501
+"""
+import sys
+
+from streamlit.web import cli as stcli
+
+from services import demarrer_services
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    demarrer_services()
+    sys.argv = ["streamlit", "run", "app.py", *argv]
+    return stcli.main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""Services de fond du processus : serveur de métriques, /healthz, /readyz et préchauffage
+
+serve.py les démarre avant le serveur Streamlit, pour que l'instance chauffe sans attendre une
+première session ; app.py les démarre aussi (sans effet s'ils tournent déjà) pour `streamlit run app.py`.
+"""
+import threading
+
+from auth_functions import warm_face_models, warm_database
+from cbir_functions import valider_signatures, rechauffer_recherche
+from metrics import demarrer_serveur_metriques
+from session_store import get_session_store
+from warmup import demarrer_rechauffement
+
+_verrou = threading.Lock()
+_demarre = False
+_serveur = None
+
+
+def demarrer_services():
+    """Démarre une seule fois par processus le serveur de métriques et le préchauffage"""
+    global _demarre, _serveur
+    with _verrou:
+        if _demarre:
+            return _serveur
+
+        # Une configuration invalide (secret de session absent) doit empêcher le démarrage
+        get_session_store()
+
+        _serveur = demarrer_serveur_metriques()
+        demarrer_rechauffement([
+            ("modeles_visage", warm_face_models),
+            ("mongodb", warm_database),
+            ("sessions", get_session_store),
+            ("signatures", valider_signatures),
+            ("requete_test", rechauffer_recherche)
+        ])
+        _demarre = True
+        return _serveur
@@ -0,0 +1,221 @@
+import os
+import hmac
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import secrets
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+SESSION_BACKEND = os.environ.get("CBIR_SESSION_BACKEND", "sqlite")
+SESSION_DB_PATH = os.environ.get("CBIR_SESSION_DB", "./sessions.db")
+SESSION_TTL = int(os.environ.get("CBIR_SESSION_TTL", str(12 * 3600)))
+OAUTH_STATE_TTL = 600
+
+logger = logging.getLogger("cbir.sessions")
+
+# Toutes les répliques doivent partager le même secret pour valider les jetons ;
+# un secret aléatoire propre au processus n'est admis qu'avec le stockage en mémoire
+SESSION_SECRET = os.environ.get("CBIR_SESSION_SECRET", "")
+EPHEMERAL_SECRET = not SESSION_SECRET
+if EPHEMERAL_SECRET:
+    SESSION_SECRET = secrets.token_hex(32)
+
+
+class SessionStore(ABC):
+    """Stockage clé-valeur côté serveur avec expiration, partagé entre les répliques"""
+
+    @abstractmethod
+    def get(self, key):
+        """Valeur associée à la clé, ou None si absente ou expirée"""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Associe une valeur à la clé pour `ttl` secondes"""
+
+    @abstractmethod
+    def delete(self, key):
+        """Supprime la clé si elle existe"""
+
+    def pop(self, key):
+        value = self.get(key)
+        if value is not None:
+            self.delete(key)
+        return value
+
+
+class MemorySessionStore(SessionStore):
+    """Stockage en mémoire, limité à un processus (tests et développement)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop(self, key):
+        # Lecture et suppression atomiques : un état OAuth ne sert qu'une fois
+        with self._lock:
+            value, expires = self._data.pop(key, (None, 0))
+        return value if expires > time.time() else None
+
+
+class SqliteSessionStore(SessionStore):
+    """Stockage clé-valeur SQLite, partageable par les répliques via un volume commun"""
+
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM sessions WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl)
+            )
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def pop(self, key):
+        # Lecture et suppression atomiques : un état OAuth ne sert qu'une fois
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value FROM sessions WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        return json.loads(row[0]) if row else None
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Instancie le stockage de sessions configuré
+
+    Lève RuntimeError si le stockage est partagé mais que CBIR_SESSION_SECRET n'est pas défini :
+    les jetons signés par une réplique seraient refusés par toutes les autres.
+    """
+    if backend == "memory":
+        if EPHEMERAL_SECRET:
+            logger.warning("CBIR_SESSION_SECRET absent : secret aléatoire propre à ce processus")
+        return MemorySessionStore()
+    if EPHEMERAL_SECRET:
+        raise RuntimeError(f"CBIR_SESSION_SECRET doit être défini avec le stockage de sessions {backend}")
+    return SqliteSessionStore()
+
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def get_session_store():
+    """Stockage de sessions unique du processus, créé au premier appel"""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = create_session_store()
+        return _shared_store
+
+
+def sign(value):
+    """Ajoute une signature HMAC à une valeur"""
+    signature = hmac.new(SESSION_SECRET.encode(), value.encode(), hashlib.sha256).hexdigest()
+    return f"{value}.{signature}"
+
+
+def unsign(token):
+    """Renvoie la valeur d'un jeton signé, ou None si la signature est invalide"""
+    if not token or "." not in token:
+        return None
+    value, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(sign(value), token):
+        return None
+    return value
+
+
+def create_session(store, username, auth_method, ttl=SESSION_TTL):
+    """Ouvre une session authentifiée et renvoie son jeton signé"""
+    session_id = secrets.token_urlsafe(24)
+    store.set(f"session:{session_id}", {"username": username, "auth_method": auth_method}, ttl)
+    return sign(session_id)
+
+
+def load_session(store, token):
+    """Données de la session associée au jeton, ou None si invalide ou expirée"""
+    session_id = unsign(token)
+    if session_id is None:
+        return None
+    return store.get(f"session:{session_id}")
+
+
+def delete_session(store, token):
+    session_id = unsign(token)
+    if session_id is not None:
+        store.delete(f"session:{session_id}")
+
+
+def create_oauth_state(store, provider, redirect_page, nonce):
+    """Crée un état OAuth à usage unique, valable sur toutes les répliques
+
+    `nonce` est aussi déposé dans un cookie du navigateur qui lance la connexion : seul ce navigateur
+    pourra consommer l'état.
+    """
+    state = sign(secrets.token_urlsafe(24))
+    store.set(
+        f"oauth:{state}", {"provider": provider, "redirect_page": redirect_page, "nonce": nonce}, OAUTH_STATE_TTL
+    )
+    return state
+
+
+def consume_oauth_state(store, state, nonce):
+    """Consomme un état OAuth et renvoie son contexte, ou None (protection CSRF)
+
+    L'état est refusé s'il est inconnu, expiré, déjà utilisé ou émis pour un autre navigateur.
+    """
+    if unsign(state) is None or not nonce:
+        return None
+    context = store.pop(f"oauth:{state}")
+    if context is None or not hmac.compare_digest(context.get("nonce", "").encode(), nonce.encode()):
+        return None
+    return context
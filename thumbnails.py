@@ -0,0 +1,106 @@
+import os
+import hashlib
+from functools import lru_cache
+
+import cv2
+
+THUMBNAILS_PATH = "./miniatures/"
+TAILLE_MINIATURE = 150  # Même largeur que la grille de résultats : Streamlit sert l'image telle quelle
+QUALITE_JPEG = 85
+TAILLE_CACHE_LRU = 512
+EXTENSIONS_IMAGES = ('.png', '.jpg', '.bmp', '.jpeg')
+
+
+def chemin_miniature(relative_path, mtime_ns):
+    """Chemin de la miniature associée à une image (clé : chemin relatif + mtime)"""
+    cle = hashlib.sha1(relative_path.replace(os.sep, "/").encode("utf-8")).hexdigest()
+    return os.path.join(THUMBNAILS_PATH, cle[:2], f"{cle}_{mtime_ns}.jpg")
+
+
+def generer_miniature(source, destination):
+    """Génère une miniature JPEG de taille fixe à partir d'une image du dataset"""
+    img = cv2.imread(source, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Impossible de lire l'image: {source}")
+
+    hauteur, largeur = img.shape[:2]
+    echelle = TAILLE_MINIATURE / max(hauteur, largeur)
+    if echelle < 1:
+        taille = (max(1, round(largeur * echelle)), max(1, round(hauteur * echelle)))
+        img = cv2.resize(img, taille, interpolation=cv2.INTER_AREA)
+
+    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, QUALITE_JPEG])
+    if not ok:
+        raise ValueError(f"Impossible d'encoder la miniature: {source}")
+
+    # Écriture atomique pour ne jamais servir une miniature tronquée
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temporaire = f"{destination}.{os.getpid()}.tmp"
+    with open(temporaire, "wb") as f:
+        f.write(buffer.tobytes())
+    os.replace(temporaire, destination)
+    return destination
+
+
+@lru_cache(maxsize=TAILLE_CACHE_LRU)
+def _lire_miniature(chemin):
+    # Une miniature absente lève FileNotFoundError, qui n'est pas mis en cache
+    with open(chemin, "rb") as f:
+        return f.read()
+
+
+def obtenir_miniature(chemin_dossier, relative_path, remplissage_paresseux=True):
+    """Renvoie les octets JPEG de la miniature d'une image, ou None si indisponible"""
+    source = os.path.join(chemin_dossier, relative_path)
+    try:
+        mtime_ns = os.stat(source).st_mtime_ns
+    except OSError:
+        return None
+
+    chemin = chemin_miniature(relative_path, mtime_ns)
+    try:
+        return _lire_miniature(chemin)
+    except FileNotFoundError:
+        if not remplissage_paresseux:
+            return None
+
+    try:
+        generer_miniature(source, chemin)
+    except (ValueError, OSError):
+        return None
+    return _lire_miniature(chemin)
+
+
+def construire_miniatures(chemin_dossier, progression=None):
+    """Construit les miniatures manquantes du dataset et supprime les miniatures obsolètes"""
+    images = []
+    for root, dirs, files in os.walk(chemin_dossier):
+        for file in files:
+            if file.lower().endswith(EXTENSIONS_IMAGES):
+                images.append(os.path.relpath(os.path.join(root, file), chemin_dossier))
+
+    attendues = set()
+    generees = 0
+    for i, relative_path in enumerate(images):
+        source = os.path.join(chemin_dossier, relative_path)
+        try:
+            chemin = chemin_miniature(relative_path, os.stat(source).st_mtime_ns)
+            attendues.add(os.path.abspath(chemin))
+            if not os.path.exists(chemin):
+                generer_miniature(source, chemin)
+                generees += 1
+        except (ValueError, OSError):
+            pass
+
+        if progression is not None:
+            progression((i + 1) / len(images))
+
+    # Les miniatures d'images modifiées ou supprimées ne sont plus référencées
+    for root, dirs, files in os.walk(THUMBNAILS_PATH):
+        for file in files:
+            chemin = os.path.abspath(os.path.join(root, file))
+            if file.endswith(".jpg") and chemin not in attendues:
+                os.remove(chemin)
+
+    _lire_miniature.cache_clear()
+    return generees
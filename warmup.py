@@ -0,0 +1,93 @@
+import json
+import time
+import logging
+import threading
+
+from metrics import enregistrer_route
+
+# Attente entre deux tentatives des étapes en échec, doublée à chaque tour
+DELAI_INITIAL = 1.0
+DELAI_MAX = 60.0
+
+logger = logging.getLogger("cbir.warmup")
+
+_verrou = threading.Lock()
+_etat = {'statut': 'en_attente', 'etapes': {}}
+
+
+def _executer_etape(nom, fonction, tentative):
+    debut = time.perf_counter()
+    try:
+        details = fonction()
+    except Exception as e:
+        logger.exception("Échec de l'étape de préchauffage %s", nom)
+        resultat = {'statut': 'erreur', 'erreur': str(e)}
+    else:
+        resultat = {'statut': 'ok', 'details': details}
+    resultat['duree_s'] = round(time.perf_counter() - debut, 3)
+    resultat['tentatives'] = tentative
+
+    with _verrou:
+        _etat['etapes'][nom] = resultat
+    return resultat['statut'] == 'ok'
+
+
+def rechauffer(etapes, delai_initial=DELAI_INITIAL, delai_max=DELAI_MAX, tentatives_max=None):
+    """Exécute les étapes de préchauffage (nom, fonction) dans l'ordre et met à jour l'état de santé
+
+    Les étapes en échec sont relancées avec un délai croissant jusqu'à leur succès (ou `tentatives_max`) ;
+    l'instance n'est déclarée prête qu'une fois toutes les étapes réussies.
+    """
+    with _verrou:
+        _etat['statut'] = 'en_cours'
+        _etat['etapes'] = {nom: {'statut': 'en_attente'} for nom, _ in etapes}
+
+    restantes = list(etapes)
+    delai = delai_initial
+    tentative = 1
+    while True:
+        restantes = [(nom, fonction) for nom, fonction in restantes if not _executer_etape(nom, fonction, tentative)]
+        if not restantes:
+            break
+        if tentatives_max is not None and tentative >= tentatives_max:
+            with _verrou:
+                _etat['statut'] = 'erreur'
+            return False
+
+        logger.warning("Étapes de préchauffage en échec (%s), nouvelle tentative dans %.0f s",
+                       ", ".join(nom for nom, _ in restantes), delai)
+        time.sleep(delai)
+        delai = min(delai * 2, delai_max)
+        tentative += 1
+
+    with _verrou:
+        _etat['statut'] = 'pret'
+    return True
+
+
+def demarrer_rechauffement(etapes):
+    """Lance le préchauffage dans un thread et expose /healthz et /readyz"""
+    enregistrer_route("/healthz", lambda: (200, "application/json", json.dumps({'statut': 'vivant'})))
+    enregistrer_route("/readyz", lambda: _reponse_readyz())
+
+    thread = threading.Thread(target=rechauffer, args=(etapes,), name="cbir-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def etat_sante():
+    """Copie de l'état du préchauffage"""
+    with _verrou:
+        return {'statut': _etat['statut'], 'etapes': {nom: dict(e) for nom, e in _etat['etapes'].items()}}
+
+
+def est_pret():
+    with _verrou:
+        return _etat['statut'] == 'pret'
+
+
+def _reponse_readyz():
+    # 503 tant que l'instance n'est pas chaude : le répartiteur ne lui envoie pas de trafic
+    etat = etat_sante()
+    statut = 200 if etat['statut'] == 'pret' else 503
+    return statut, "application/json", json.dumps(etat, ensure_ascii=False, default=str)